@@ -2,11 +2,15 @@
 
 from __future__ import print_function
 
+import json
 import struct
 from array import array
+from binascii import crc_hqx
+from collections import deque
+import os
+import random
 import sys
 import time
-import usb
 
 Requests = {
         'NEXT' : B'\x06',
@@ -81,6 +85,105 @@ DFUComm = {
     }
 
 
+def crc16_table(poly=0x1021):
+    table = []
+    for i in range(256):
+        c = i << 8
+        for j in range(8):
+            c = ((c << 1) ^ poly) if c & 0x8000 else (c << 1)
+        table.append(c & 0xffff)
+    return table
+
+
+class DM1702_crc16(object):
+    """Incremental CRC16-XMODEM (polynomial 0x1021, initial value 0), uses
+    binascii.crc_hqx (the same CRC) or a 256-entry table lookup."""
+    use_binascii = True
+    table = crc16_table()
+
+    def __init__(self, data=None, crc=0x0000):
+        self.crc = crc
+        if data is not None:
+            self.update(data)
+
+    def update(self, data):
+        """Adds data (bytes, bytearray, memoryview, array or str) to the CRC."""
+        if isinstance(data, str) and not isinstance(data, bytes):
+            data = data.encode('latin-1')
+        if self.use_binascii:
+            self.crc = crc_hqx(data, self.crc)
+        else:
+            crc = self.crc
+            table = self.table
+            for c in bytearray(data):
+                crc = ((crc << 8) & 0xff00) ^ table[(crc >> 8) ^ c]
+            self.crc = crc
+        return self
+
+    def digest(self):
+        return bytes(bytearray([self.crc >> 8, self.crc & 0xff]))
+
+
+class DM1702_transport(object):
+    """Packet transport between DM1702_DFU and a radio. Reads return
+    array('B') packets of at most size bytes and raise IOError on timeout,
+    default_timeout is in ms (as in PyUSB)."""
+    packet_size = 64
+    default_timeout = 1000
+
+    def write(self, data):
+        raise NotImplementedError
+
+    def read(self, size, timeout=None):
+        raise NotImplementedError
+
+class USBTransport(DM1702_transport):
+    """Transport over the bulk endpoints of a PyUSB device."""
+
+    def __init__(self, device, alt=0):
+        import usb.util
+        self._device = device
+        device.set_configuration(1)
+        # get an endpoint instance
+        cfg = device.get_active_configuration()
+        intf = cfg[(0,0)]
+        ep = usb.util.find_descriptor(
+            intf,
+            # match the first OUT endpoint
+            custom_match = \
+            lambda e: \
+                usb.util.endpoint_direction(e.bEndpointAddress) == \
+                usb.util.ENDPOINT_OUT)
+
+        assert ep is not None
+
+        ep2 = usb.util.find_descriptor(
+            intf,
+            # match the first OUT endpoint
+            custom_match = \
+            lambda e: \
+                usb.util.endpoint_direction(e.bEndpointAddress) == \
+                usb.util.ENDPOINT_IN)
+
+        assert ep2 is not None
+        self._ep=ep
+        self._ep2=ep2
+        self.packet_size = ep2.wMaxPacketSize
+
+    @property
+    def default_timeout(self):
+        return self._device.default_timeout
+
+    @default_timeout.setter
+    def default_timeout(self, timeout):
+        self._device.default_timeout = timeout
+
+    def write(self, data):
+        self._ep.write(data)
+
+    def read(self, size, timeout=None):
+        return self._device.read(self._ep2.bEndpointAddress, size, timeout)
+
 class DM1702_DFU(object):
     #verbose = True
     verbose = False
@@ -88,20 +191,18 @@ class DM1702_DFU(object):
     max_fw_size = 0xF7000
     min_known_fw_size = 0x9EF00
     delta = 0x40 # Maximum save block size is 64 bytes
+    read_delta = write_delta = delta # SPI READ/WRITE lengths, see tune()
+    tune_lengths = [1 << i for i in range(6, 13)]
+    probe_timeout = 500 # ms to wait for a reply to a probed length
+    validate_chunks = 4 # random chunks compared besides the head and tail of a cached sector
     model = Models[0]
+    window = 1 # SPI read requests in flight, 1 means stop-and-wait
+    drain_timeout = 200 # ms to wait for stale replies after a pipeline stall
 
     @staticmethod
     def crc16_xmodem(data, crc=0x0000):
-        msb = crc >> 8
-        lsb = crc & 255
-        for c in data:
-            if (type(c) == type('c')): # Python 3
-                c = ord(c)
-            x = c ^ msb
-            x ^= (x >> 4)
-            msb = (lsb ^ (x >> 3) ^ (x << 4)) & 255
-            lsb = (x ^ (x << 5)) & 255
-        return chr(msb) + chr(lsb)
+        crc = DM1702_crc16(data, crc).crc
+        return chr(crc >> 8) + chr(crc & 0xff)
 
     @staticmethod
     def _wait():
@@ -143,33 +244,233 @@ class DM1702_DFU(object):
     def __init__(self, device, alt):
         self.cps_start = 0x001000
         self.cps_end = 0x0c8fff
+        self.cache = None
+        self.cache_config = None
+        self.stats = None
+        self.tune_config = None
+        self._validated = set()
+
+        if isinstance(device, DM1702_transport):
+            self._transport = device
+        else:
+            self._transport = USBTransport(device, alt)
 
-        self._device = device
-        device.set_configuration(1)
-        # get an endpoint instance
-        cfg = device.get_active_configuration()
-        intf = cfg[(0,0)]
-        ep = usb.util.find_descriptor(
-            intf,
-            # match the first OUT endpoint
-            custom_match = \
-            lambda e: \
-                usb.util.endpoint_direction(e.bEndpointAddress) == \
-                usb.util.ENDPOINT_OUT)
+    @staticmethod
+    def find_devices(vendor, product, locations=None):
+        """Returns all attached radios, optionally only those at the given
+        comma separated bus:port locations (see location)."""
+        import usb.core
+        devices = list(usb.core.find(find_all=True, idVendor=vendor, idProduct=product))
+        if locations is not None:
+            locations = locations.split(',')
+            devices = [dev for dev in devices if DM1702_DFU.location(dev) in locations]
+        return devices
 
-        assert ep is not None
+    @staticmethod
+    def location(device):
+        """Returns bus:port[.port] of a device (bus:address if ports are not
+        known), which stays the same when the radio is rebooted."""
+        ports = getattr(device, 'port_numbers', None)
+        if ports:
+            return '%i:%s' % (device.bus, '.'.join(['%i' % port for port in ports]))
+        return '%i:%i' % (device.bus, device.address)
 
-        ep2 = usb.util.find_descriptor(
-            intf,
-            # match the first OUT endpoint
-            custom_match = \
-            lambda e: \
-                usb.util.endpoint_direction(e.bEndpointAddress) == \
-                usb.util.ENDPOINT_IN)
+    @staticmethod
+    def probe_id(device, alt=0):
+        """Returns the device ID of a radio in normal mode. It is only available
+        in SPI USB mode, so the radio is rebooted afterwards and has to be
+        looked up again (see wait_device)."""
+        device.default_timeout = 3000
+        dfu = DM1702_DFU(device, alt)
+        dfu.enter_dfu_mode()
+        dfu.enter_spi_usb_mode()
+        device_id = dfu.hd(dfu.verify(Versions['DeviceID']))
+        dfu.reboot()
+        if not isinstance(device, DM1702_transport):
+            import usb.util
+            usb.util.dispose_resources(device)
+        return device_id
 
-        assert ep2 is not None
-        self._ep=ep
-        self._ep2=ep2
+    @staticmethod
+    def wait_device(vendor, product, location, timeout=20):
+        """Waits for a rebooted radio to appear at location again."""
+        end = time.time() + timeout
+        time.sleep(1)
+        while time.time() < end:
+            devices = DM1702_DFU.find_devices(vendor, product, location)
+            if devices:
+                return devices[0]
+            time.sleep(0.5)
+        raise RuntimeError('Radio at %s did not come back after reboot' % location)
+
+    # Help of the options read by select_devices, for the tool usage texts
+    select_usage = """    --device=BUS:PORT[,...]
+                    use radios at the given USB locations (see md1702-dfu devices)
+    --device-id=ID[,...]
+                    use radios with the given device IDs, radios are identified
+                    in SPI USB mode and rebooted before use (commands for
+                    one radio use the first one found)
+"""
+
+    @staticmethod
+    def select_devices(vendor, product, options, alt=0):
+        """Returns radios selected by --device=BUS:PORT[,...] and
+        --device-id=ID[,...] options, all attached radios by default."""
+        devices = DM1702_DFU.find_devices(vendor, product, options.get('device'))
+        if 'device-id' not in options:
+            return devices
+        wanted = [i.strip().lower().replace('0x', '') for i in options['device-id'].split(',')]
+        locations = []
+        for dev in devices:
+            location = DM1702_DFU.location(dev)
+            if DM1702_DFU.probe_id(dev, alt) in wanted:
+                locations.append(location)
+        return [DM1702_DFU.wait_device(vendor, product, location) for location in locations]
+
+    @staticmethod
+    def select_device(vendor, product, options, alt=0):
+        """Returns the first radio selected by select_devices, warns when more
+        than one is selected."""
+        devices = DM1702_DFU.select_devices(vendor, product, options, alt)
+        if len(devices) == 0:
+            raise RuntimeError('Device not found')
+        if len(devices) > 1:
+            sys.stderr.write("%i radios found, using the one at %s (select with --device or --device-id)\n" %
+                             (len(devices), DM1702_DFU.location(devices[0])))
+        return devices[0]
+
+    def configure(self, options):
+        """Applies command line options (see DM1702_util.pop_options)."""
+        if 'window' in options:
+            self.window = max(1, int(options['window']))
+        if 'cache' in options:
+            self.enable_cache(None if options['cache'] is True else options['cache'],
+                              int(options['cache-size']) << 20 if 'cache-size' in options else None)
+        if 'stats' in options:
+            self.enable_stats()
+        if 'tune' in options:
+            flags = options['tune'].split(',') if options['tune'] is not True else []
+            self.tune_config = {'write' : 'write' in flags, 'rescan' : 'rescan' in flags}
+
+    def enable_stats(self, callback=None):
+        """Counts and times requests and USB transfers (see DM1702_stats), the
+        summary is passed to callback(summary) or printed at exit."""
+        from DM1702_stats import DM1702_stats
+        self.stats = DM1702_stats(callback)
+        self.stats.install(self)
+
+    def enable_cache(self, path=None, max_size=None):
+        """Serves full SPI sectors from the on-disk sector cache, the cache is
+        opened on first use in SPI USB mode, where the device ID is known."""
+        self.cache_config = {'path' : path, 'max_size' : max_size}
+
+    def identity(self):
+        """Returns (device ID, firmware version) strings of the radio."""
+        return (self.hd(self.verify(Versions['DeviceID'])),
+                self.to_str(self.verify(Versions['FWVersion'])))
+
+    def _get_cache(self):
+        if self.cache is None:
+            from DM1702_cache import DM1702_cache
+            device_id, fw_version = self.identity()
+            self.cache = DM1702_cache(device_id, fw_version, **self.cache_config)
+        return self.cache
+
+    def tune(self, write=False, rescan=False, path=None):
+        """Sets the largest SPI READ (and with write=True also WRITE) lengths
+        accepted by the firmware, probed with increasing lengths on the first
+        codeplug sector, which is rewritten with its own contents. Results are
+        stored per model and firmware version in a JSON profile. A stored
+        profile is used after one probe with its lengths succeeds, otherwise
+        the lengths are probed again."""
+        if path is None:
+            from DM1702_cache import DM1702_cache
+            path = os.path.join(DM1702_cache.default_dir, 'chunk_profiles.json')
+        try:
+            with open(path, 'r') as f:
+                profiles = json.load(f)
+        except (IOError, OSError, ValueError):
+            profiles = {}
+        key = '%s_%s' % (self.model, self.to_str(self.verify(Versions['FWVersion'])))
+        profile = profiles.get(key, {}) if not rescan else {}
+        region = self.cps_start - (self.cps_start % self.sector_size)
+        window, self.window = self.window, 1
+        try:
+            if profile and not self._check_profile(region, profile, write):
+                sys.stderr.write("Stored SPI request lengths %s were rejected, probing again\n" % profile)
+                profile = {}
+            if 'read' not in profile or (write and 'write' not in profile):
+                reference = self._upload_spi(region, self.sector_size, self.delta, None, True)
+                if 'read' not in profile:
+                    profile['read'] = self._probe_lengths(lambda l:
+                        self._upload_spi(region, self.sector_size, l, None, True) == reference)
+                if write and 'write' not in profile:
+                    profile['write'] = self._probe_lengths(lambda l: self._probe_write(region, reference, l))
+                    self._restore(region, reference)
+                profiles[key] = profile
+                if not os.path.isdir(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                with open(path, 'w') as f:
+                    json.dump(profiles, f, indent=1, sort_keys=True)
+        finally:
+            self.window = window
+        self.read_delta = profile['read']
+        self.write_delta = profile['write'] if write else self.delta
+        return profile
+
+    def _check_profile(self, address, profile, write=False):
+        """Returns True if a READ (and with write=True a WRITE) request of the
+        stored lengths succeeds at address."""
+        l = profile.get('read', self.delta)
+        reference = self._upload_spi(address, l, self.delta, None, True)
+        if not self._probe(lambda l: self._upload_spi(address, l, l, None, True) == reference, l):
+            return False
+        if write and 'write' in profile:
+            l = profile['write']
+            reference = self._upload_spi(address, l, self.delta, None, True)
+            ok = self._probe(lambda l: self._probe_write(address, reference, l), l)
+            self._restore(address, reference)
+            return ok
+        return True
+
+    def _probe(self, test, length):
+        """Returns test(length) run with the probe timeout, False when the
+        request was rejected (stale replies are drained then)."""
+        timeout = self._transport.default_timeout
+        self._transport.default_timeout = self.probe_timeout
+        try:
+            if test(length):
+                return True
+        except Exception as e: # IOError (timeout) or an invalid reply
+            if self.verbose:
+                print("Length %i rejected: %s" % (length, e))
+        finally:
+            self._transport.default_timeout = timeout
+        self._drain()
+        return False
+
+    def _probe_lengths(self, test):
+        """Returns the largest length passing test(length), tried in increasing
+        order from the model default until the first failure."""
+        best = self.delta
+        limit = min(self.sector_size, 0xffff if self.model == 'DM1702S' else 0xff)
+        for l in [l for l in self.tune_lengths if self.delta < l <= limit]:
+            if not self._probe(test, l):
+                break
+            best = l
+        return best
+
+    def _probe_write(self, address, reference, length):
+        """Rewrites SPI data with its contents in chunks of length and reads it back."""
+        self.download_spi(address, reference, delta=length, silent=True)
+        return self._upload_spi(address, len(reference), self.delta, None, True) == reference
+
+    def _restore(self, address, reference):
+        """Rewrites reference with default length chunks after a failed write probe."""
+        if self._upload_spi(address, len(reference), self.delta, None, True) != reference:
+            sys.stderr.write("Restoring SPI data at 0x%06x after a failed write probe\n" % address)
+            if not self._probe_write(address, reference, self.delta):
+                raise Exception('Restoring SPI data at 0x%06x failed' % address)
 
     def set_time(self, tstr=None):
         from datetime import datetime
@@ -195,21 +496,52 @@ class DM1702_DFU(object):
         if data != Statuses['OK'] :
             raise Exception('Time setting failed')
 
+    def fw_blocks(self, source, length):
+        """Yields (block, crc) XMODEM blocks (sequence byte, its complement and
+        1024 bytes of payload) of firmware padded with 0xff to a sector
+        boundary. Source is a buffer (bytes, memoryview, mmap) or a file
+        object read sequentially, the same block buffer is reused."""
+        padded = ((length + self.sector_size - 1) // self.sector_size) * self.sector_size
+        view = None if hasattr(source, 'readinto') else memoryview(source)
+        block = bytearray(1026)
+        payload = memoryview(block)[2:]
+        for block_id, pos in enumerate(range(0, padded, 1024), 1):
+            block[0] = block_id & 0xff
+            block[1] = 0xff - block[0]
+            n = max(0, min(1024, length - pos))
+            if view is not None:
+                payload[:n] = view[pos:pos+n]
+            else:
+                got = 0
+                while got < n:
+                    r = source.readinto(payload[got:n])
+                    if not r:
+                        raise Exception('Firmware file truncated at %i bytes' % (pos + got))
+                    got += r
+            if n < 1024:
+                payload[n:] = b'\xff' * (1024 - n)
+            yield block, DM1702_crc16(payload).digest()
+
     def download_fw(self, in_data, name="firmware.bin"):
-        if len(in_data) > self.max_fw_size or len(in_data) < self.min_known_fw_size:
-            raise Exception("Firmware size %i is not between %i and %i bytes, sanity check failed" % (len(in_data), self.min_known_fw_size, self.max_fw_size))
+        """Upgrades firmware from a buffer or from an open (binary) file."""
+        if hasattr(in_data, 'readinto'):
+            length = os.fstat(in_data.fileno()).st_size - in_data.tell()
+            start = in_data.tell()
+            hdr = bytearray(in_data.read(16))
+            in_data.seek(start)
+        else:
+            length = len(in_data)
+            hdr = bytearray(in_data[:16])
+        if length > self.max_fw_size or length < self.min_known_fw_size:
+            raise Exception("Firmware size %i is not between %i and %i bytes, sanity check failed" % (length, self.min_known_fw_size, self.max_fw_size))
 
         cf = "Firmware header sanity check failed, probably trying to flash encrypted firmware (use official app)"
-        if isinstance(in_data, str):
-            if in_data[3] != '\x20' or in_data[2] > '\x01' or in_data[7] != '\x08' or in_data[0xb] != '\x08' or in_data[0xf] != '\x08':
-                raise Exception(cf)
-        else:
-            if in_data[3] != 0x20 or in_data[2] > 0x01 or in_data[7] != 0x08 or in_data[0xb] != 0x08 or in_data[0xf] != 0x08:
-                raise Exception(cf)
+        if hdr[3] != 0x20 or hdr[2] > 0x01 or hdr[7] != 0x08 or hdr[0xb] != 0x08 or hdr[0xf] != 0x08:
+            raise Exception(cf)
 
         # Generate packet with metadata
         name=name.split('/')[-1]
-        header=(B'\x00\xff%s\x00%i' % (name.encode(), len(in_data)))
+        header=(B'\x00\xff%s\x00%i' % (name.encode(), length))
         header += B'\x00' * (130-len(header))
         #raise Exception('Firmware upgrade is not implemented yet, some parts are missing');
 
@@ -226,33 +558,14 @@ class DM1702_DFU(object):
         if result != DFUComm['Continue'] :
             raise Exception('Entering FW update stage 1 failed')
         self.send_text(header)
-        self.send_text(self.crc16_xmodem(header[2:]))
+        self.send_text(DM1702_crc16(memoryview(header)[2:]).digest())
         time.sleep(0.1)
         result = self.read_reply()
         if result != DFUComm['OKContinue'] :
             raise Exception('Sending file name failed')
         print('Sending file name succeeded, starting upgrade')
-        block_id=1
         caddr=0x8000
-        #print("Length of data before padding %i" % len(in_data))
-        if len(in_data) % self.sector_size != 0:
-            pad_l = self.sector_size - (len(in_data) % self.sector_size)
-            if isinstance(in_data, str):
-                in_data += '\xff' * pad_l
-            else:
-                i2 = bytearray(in_data)
-                for i in range(0,pad_l):
-                    i2.append(0xff)
-                in_data = bytes(i2)
-        #print("Length of data after padding %i" % len(in_data))
-        while len(in_data) > 0:
-            if isinstance(in_data, str):
-                block=chr(block_id & 0xff) + chr((0xff-(block_id & 0xff))) + in_data[:1024]
-            else:
-                block=B"%c%c%s" % (block_id & 0xff, 0xff-(block_id & 0xff), in_data[:1024])
-            csum16=self.crc16_xmodem(in_data[:1024])
-            in_data = in_data[1024:]
-            block_id += 1
+        for block_id, (block, csum16) in enumerate(self.fw_blocks(in_data, length), 1):
             self.send_text(DFUComm['Stage2'])
             result = self.read_reply()
             if result != DFUComm['Continue'] :
@@ -273,7 +586,7 @@ class DM1702_DFU(object):
         print('Upgrade finished, turn the device off and on normally')
 
     def set_timeout(self, timeout):
-        self._device.default_timeout = timeout
+        self._transport.default_timeout = timeout
 
     def reboot(self):
         self.send_text(Requests['NEXT'])
@@ -301,7 +614,7 @@ class DM1702_DFU(object):
           elif (caddr % self.sector_size) == 0:
               sys.stdout.write('.')
               sys.stdout.flush()
-          if (address+length-caddr) < self.delta :
+          if (address+length-caddr) < l :
               l = address+length-caddr
           self.send_data(Requests['GET'],  self.fladdr2bytes(caddr),l)
           code, addr, l2, d2 = self.read()
@@ -319,35 +632,164 @@ class DM1702_DFU(object):
     def upload_spi(self, address, length, delta=None, delay=None, crop=True, silent=False):
         if self.verbose:
             print("Fetching %i bytes of data from SPI at 0x%06x." % (length, address))
-        caddr = address
+        if self.cache_config is not None and delay is None:
+            data = self._upload_spi_cached(address, length, delta, silent)
+        else:
+            data = self._upload_spi(address, length, delta, delay, silent)
+        if not self.verbose and not silent:
+            print('')
+        if crop:
+            return array('B',(self.dtrim(data)))
+        else:
+            return array('B',data)
+
+    def _upload_spi(self, address, length, delta=None, delay=None, silent=False):
         if delta is None:
-            l = self.delta
+            l = self.read_delta
         else:
             l = delta
-        data = []
+        chunks = []
+        caddr = address
         while address + length > caddr :
+          chunks.append((caddr, min(l, address+length-caddr)))
+          caddr += l
+        return self._upload_spi_chunks(chunks, delay, silent)
+
+    def _upload_spi_chunks(self, chunks, delay=None, silent=False):
+        """Reads a list of (address, length) chunks, returns concatenated data."""
+        data = []
+        done = 0
+        if self.window > 1 and delay is None:
+            done = self._upload_spi_pipelined(chunks, data, silent)
+        for caddr, l in chunks[done:]:
           if self.verbose:
               print("Upload request at 0x%06x, l=%i" % (caddr, l))
           elif (caddr % self.sector_size) == 0 and not silent:
               sys.stdout.write('.')
               sys.stdout.flush()
-          if (address+length-caddr) < self.delta :
-              l = address+length-caddr
           self.send_data(Requests['READ'],  self.spiaddr2bytes(caddr),l)
           code, addr, l2, d2 = self.read()
           if code != Requests['WRITE'] or l2 != l :
             raise Exception("Invalid reply for SPI upload: %c, len=%i (asked %i)" % (code, l2, l))
           data += d2
-          caddr += l
           self.next_cmd()
           if delay is not None:
               time.sleep(delay)
-        if not self.verbose and not silent:
-            print('')
-        if crop:
-            return array('B',(self.dtrim(data)))
-        else:
-            return array('B',data)
+        return data
+
+    def estimate_upload_time(self, address, length, probes=16):
+        """Returns seconds expected for reading length bytes of SPI, measured
+        by timing a few full size chunks read at address."""
+        count = probes * self.window
+        address = min(address, 0x1000000 - count * self.read_delta)
+        start = time.time()
+        self._upload_spi_chunks([(address + i * self.read_delta, self.read_delta) for i in range(count)], silent=True)
+        return (time.time() - start) * length / float(count * self.read_delta)
+
+    def _upload_spi_cached(self, address, length, delta=None, silent=False):
+        """Reads through the sector cache, reads covering at least half of
+        a sector fetch and cache the whole sector."""
+        data = []
+        pos = address
+        while pos < address + length:
+            sector = pos - (pos % self.sector_size)
+            end = min(address + length, sector + self.sector_size)
+            cached = self._cached_sector(sector, (end - pos) * 2 >= self.sector_size, delta)
+            if cached is None:
+                data += self._upload_spi(pos, end - pos, delta, None, silent)
+            else:
+                data += cached[pos - sector:end - sector]
+                if pos == sector and not silent and not self.verbose:
+                    sys.stdout.write('.')
+                    sys.stdout.flush()
+            pos = end
+        return data
+
+    def _cached_sector(self, sector, fetch, delta=None):
+        cache = self._get_cache()
+        data = cache.get(sector)
+        if data is not None:
+            if sector in self._validated:
+                return data
+            chunks = self._validation_chunks(sector)
+            if self._upload_spi_chunks(chunks, silent=True) == [b for pos, l in chunks for b in data[pos - sector:pos - sector + l]]:
+                self._validated.add(sector)
+                return data
+        if not fetch:
+            return None
+        data = bytearray(self._upload_spi(sector, self.sector_size, delta, None, True))
+        cache.put(sector, data)
+        self._validated.add(sector)
+        return data
+
+    def _validation_chunks(self, sector):
+        """Returns (address, length) chunks compared to validate a cached
+        sector: the head, the tail with the block ID mark and validate_chunks
+        chunks at random positions in between, so that a change anywhere in
+        the sector is found sooner or later by repeated validation."""
+        l = min(self.read_delta, self.sector_size)
+        middle = list(range(l, self.sector_size - 2 * l + 1, l))
+        picked = sorted(random.sample(middle, min(self.validate_chunks, len(middle))))
+        return [(sector + pos, l) for pos in [0] + picked + [self.sector_size - l]]
+
+    def update_cache(self, address, data):
+        """Updates the sector cache after data was written to SPI at address,
+        the cache is opened if needed, so that no stale sector survives."""
+        if self.cache_config is None:
+            return
+        cache = self._get_cache()
+        for sector in range(address - (address % self.sector_size), address + len(data), self.sector_size):
+            if sector >= address and sector + self.sector_size <= address + len(data):
+                cache.put(sector, bytearray(data[sector - address:sector - address + self.sector_size]))
+                self._validated.add(sector)
+            else:
+                cache.invalidate(sector)
+                self._validated.discard(sector)
+
+    def _upload_spi_pipelined(self, chunks, data, silent=False):
+        """Keeps up to self.window READ/NEXT pairs in flight, appends replies
+        to data and returns the number of chunks received. On a stall or an
+        out of order reply, drains the endpoint and switches the session to
+        stop-and-wait, the caller then continues from the returned index."""
+        pending = deque()
+        done = sent = 0
+        caddr = l = 0
+        try:
+            while done < len(chunks):
+                # the oldest request in the window is the one being answered
+                caddr, l = chunks[done]
+                while sent < len(chunks) and len(pending) < self.window:
+                    raddr, rl = chunks[sent]
+                    if self.verbose:
+                        print("Pipelined upload request at 0x%06x, l=%i" % (raddr, rl))
+                    self.send_data(Requests['READ'],  self.spiaddr2bytes(raddr),rl)
+                    self.send_text(Requests['NEXT'])
+                    pending.append(chunks[sent])
+                    sent += 1
+                pending.popleft()
+                code, addr, l2, d2 = self.read()
+                if code != Requests['WRITE'] or l2 != l or list(addr) != self.spiaddr2bytes(caddr):
+                    raise Exception("out of order reply %c for 0x%06x, len=%i" % (code, addr[0] | (addr[1] << 8) | (addr[2] << 16), l2))
+                if self.read_reply() != Statuses['OK']:
+                    raise Exception('next command selection failed')
+                data += d2
+                done += 1
+                if not self.verbose and not silent and (caddr % self.sector_size) == 0:
+                    sys.stdout.write('.')
+                    sys.stdout.flush()
+        except Exception as e:
+            sys.stderr.write("\nPipelined read at 0x%06x, len=%i stalled (%s), falling back to stop-and-wait\n" % (caddr, l, e))
+            self.window = 1
+            self._drain()
+        return done
+
+    def _drain(self):
+        """Discards replies left in the endpoint by aborted pipelined requests."""
+        while True:
+            try:
+                self._transport.read(self._transport.packet_size, self.drain_timeout)
+            except IOError: # USBError is an IOError too
+                return
 
     def download_spi(self, address, data, max_length=0, delta=None, delay=None, silent=False):
         length = len(data)
@@ -358,7 +800,7 @@ class DM1702_DFU(object):
         caddr = address
         pos = 0
         if delta is None:
-            l = self.delta
+            l = self.write_delta
         else:
             l = delta
         while address + length > caddr :
@@ -367,7 +809,7 @@ class DM1702_DFU(object):
           elif (caddr % self.sector_size) == 0 and not silent:
               sys.stdout.write('.')
               sys.stdout.flush()
-          if (address+length-caddr) < self.delta :
+          if (address+length-caddr) < l :
               l = address+length-caddr
           self.send_data(Requests['WRITE'],  self.spiaddr2bytes(caddr),l, data[pos:(pos+l)])
           code = self.read_reply()
@@ -377,23 +819,41 @@ class DM1702_DFU(object):
           pos += l
           if delay is not None:
               time.sleep(delay)
+        self.update_cache(address, data)
         if not self.verbose and not silent:
             print('')
 
+    def read_marks(self, sectors):
+        """Reads block ID marks (last byte) of the given sector addresses in
+        one batch, so that the requests may be pipelined."""
+        return self._upload_spi_chunks([(start + self.sector_size - 1, 1) for start in sectors], silent=True)
+
+    def read_edges(self, sectors):
+        """Reads the first and the last chunk (with the block ID mark) of the
+        given sector addresses in one batch, returns [(head, tail), ...]."""
+        l = self.read_delta
+        chunks = []
+        for start in sectors:
+            chunks += [(start, l), (start + self.sector_size - l, l)]
+        data = bytearray(self._upload_spi_chunks(chunks, silent=True))
+        return [(data[i:i+l], data[i+l:i+2*l]) for i in range(0, len(data), 2 * l)]
+
     def get_cp_map(self):
+        """Returns block ID -> sector index map of the codeplug area, the marks
+        of all sectors are read in one batch (pipelined with window > 1)."""
         results = {}
-        for start in range (self.cps_start, self.cps_end, self.sector_size):
-            mark = self.upload_spi(start+0xfff, 1,1, crop=False, silent=True)
-            if mark is not None and len(mark) > 0 and mark[0] != 0xff and mark[0] != 0x00:
-                if (mark[0] in results): sys.stderr.write("Duplicate mark %02x\n", mark[0])
-                results[mark[0]] = int(start / self.sector_size)
+        sectors = list(range(self.cps_start, self.cps_end, self.sector_size))
+        for start, mark in zip(sectors, self.read_marks(sectors)):
+            if mark != 0xff and mark != 0x00:
+                if (mark in results): sys.stderr.write("Duplicate mark %02x\n" % mark)
+                results[mark] = int(start / self.sector_size)
                 assert int(start / self.sector_size) * self.sector_size == start
         return results
 
     def send_text(self, what):
         #if self.verbose:
         #    print("Send: %s" % what)
-        self._ep.write(what)
+        self._transport.write(what)
 
     def send_data(self, command, addr, length=None, data=None):
         if isinstance(command, str):
@@ -412,17 +872,17 @@ class DM1702_DFU(object):
         else:
             data = addr
         #print("Send: %c, data: %s" % (chr(command), self.hd(data)))
-        self._ep.write(data)
+        self._transport.write(data)
 
     def read_reply(self):
-        data=self._device.read(self._ep2.bEndpointAddress,self._ep2.wMaxPacketSize)
+        data=self._transport.read(self._transport.packet_size)
         #print("Reply: %s" % self.hd(data))
         return self.to_str(data)
 
     def read(self, verify=False):
-        data=self._device.read(self._ep2.bEndpointAddress,self._ep2.wMaxPacketSize)
+        data=self._transport.read(self._transport.packet_size)
         if (verify and len(data) < 3) or (not verify and len(data) < 5) or (not verify and self.model == 'DM1702S' and len(data) < 6):
-            data2 = self._device.read(self._ep2.bEndpointAddress,self._ep2.wMaxPacketSize)
+            data2 = self._transport.read(self._transport.packet_size)
             data = data + data2
         if verify:
             dlen=data[2]
@@ -440,7 +900,7 @@ class DM1702_DFU(object):
                 dlen=data[4]
                 data=data[5:]
         while len(data) < dlen:
-            data=data + self._device.read(self._ep2.bEndpointAddress,self._ep2.wMaxPacketSize)
+            data=data + self._transport.read(self._transport.packet_size)
         #print("Reply: %s" % self.hd(data))
         return (chr(cmd), adr, dlen, data)
 
@@ -482,7 +942,7 @@ class DM1702_DFU(object):
             raise Exception('Device detection error (status %i, device string %s)' % (ord(data[0]), RxData))
         else:
             self.model = RxData
-            self.delta = Deltas [ self.model ]
+            self.delta = self.read_delta = self.write_delta = Deltas [ self.model ]
         self.send_text(Requests['PCHECK'])
         data = self.read_reply()
         if data != Statuses['sPasswordSettingOK'] :
@@ -507,6 +967,9 @@ class DM1702_DFU(object):
         if data != Statuses['sPCM8FF'] :
             raise Exception('DMR1702 PC Mode selection failed')
         self.next_cmd()
+        if self.tune_config is not None:
+            config, self.tune_config = self.tune_config, None
+            self.tune(**config)
 
     def enter_bootloader_mode(self):
         self.send_text(DFUComm['Ready']);
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+
+# Asyncio front end of DM1702_DFU (Python 3.5+ only). PyUSB transfers are
+# blocking, so the protocol steps of every radio run in its own worker
+# thread, while the protocol itself stays implemented once in DM1702_DFU.
+# One event loop may then drive any number of radios at once, report
+# progress and cancel long transfers between SPI sectors.
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from DM1702_DFU import DM1702_DFU
+
+try:
+    running_loop = asyncio.get_running_loop
+except AttributeError: # Python < 3.7, called from coroutines only
+    running_loop = asyncio.get_event_loop
+
+class DM1702_AsyncDFU(object):
+    """Awaitable wrapper of a DM1702_DFU, the synchronous object stays
+    available as .dfu for anything not wrapped here."""
+
+    def __init__(self, dfu, executor=None):
+        self.dfu = dfu
+        self.executor = executor if executor is not None else ThreadPoolExecutor(1)
+        self.lock = asyncio.Lock()
+
+    @classmethod
+    async def open(cls, device, alt=0, options=None, dfu_mode=True):
+        """Opens a radio found by DM1702_DFU.find_devices (or a transport),
+        in program mode by default."""
+        executor = ThreadPoolExecutor(1)
+        dfu = await running_loop().run_in_executor(executor, DM1702_DFU, device, alt)
+        adfu = cls(dfu, executor)
+        if options is not None:
+            adfu.dfu.configure(options)
+        if dfu_mode:
+            device.default_timeout = 3000
+            await adfu.call(adfu.dfu.enter_dfu_mode)
+        else:
+            device.default_timeout = 5000
+        return adfu
+
+    def close(self):
+        """Stops the worker thread of the radio once its last step finishes."""
+        self.executor.shutdown(wait=False)
+
+    async def call(self, func, *args):
+        """Runs a blocking DM1702_DFU method, one at a time per radio. When
+        cancelled, the radio stays locked until the running step finishes."""
+        async with self.lock:
+            step = running_loop().run_in_executor(self.executor, func, *args)
+            try:
+                return await asyncio.shield(step)
+            except asyncio.CancelledError:
+                await asyncio.wait([step])
+                raise
+
+    async def enter_dfu_mode(self):
+        return await self.call(self.dfu.enter_dfu_mode)
+
+    async def enter_spi_usb_mode(self):
+        return await self.call(self.dfu.enter_spi_usb_mode)
+
+    async def verify(self, command, rlength=0, addr=0, stringify=False):
+        return await self.call(self.dfu.verify, command, rlength, addr, stringify)
+
+    async def verify_addrs(self, command):
+        return await self.call(self.dfu.verify_addrs, command)
+
+    async def identity(self):
+        return await self.call(self.dfu.identity)
+
+    async def set_time(self, tstr=None):
+        return await self.call(self.dfu.set_time, tstr)
+
+    async def reboot(self):
+        return await self.call(self.dfu.reboot)
+
+    def _sectors(self, address, length):
+        pos = address
+        while pos < address + length:
+            end = min(address + length, pos - (pos % self.dfu.sector_size) + self.dfu.sector_size)
+            yield pos, end - pos
+            pos = end
+
+    async def upload_spi(self, address, length, crop=True, progress=None):
+        """Reads SPI flash sector by sector, progress(done, total) is called
+        after each sector. Cancelling the task stops at a sector boundary."""
+        data = bytearray()
+        for pos, l in self._sectors(address, length):
+            data += bytearray(await self.call(self.dfu.upload_spi, pos, l, None, None, False, True))
+            if progress is not None:
+                progress(len(data), length)
+        if crop and len(data) > 0:
+            data = bytearray(self.dfu.dtrim(data))
+        return data
+
+    async def download_spi(self, address, data, progress=None):
+        """Writes SPI flash sector by sector, see upload_spi."""
+        done = 0
+        for pos, l in self._sectors(address, len(data)):
+            await self.call(self.dfu.download_spi, pos, data[done:done+l], 0, None, None, True)
+            done += l
+            if progress is not None:
+                progress(done, len(data))
+
+    async def download_fw(self, in_data, name="firmware.bin"):
+        """Upgrades firmware, this is not split as an interrupted upgrade
+        leaves the radio in the bootloader."""
+        return await self.call(self.dfu.download_fw, in_data, name)
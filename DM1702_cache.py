@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+
+import os
+import re
+import sys
+
+class DM1702_cache(object):
+    """Persistent LRU cache of 4 KiB SPI flash sectors.
+
+    Sectors are stored as one file per SPI address in a directory named after
+    the device ID and firmware version, the file modification time is used as
+    the LRU timestamp. The total size of all cached devices is capped, the
+    least recently used sectors are removed first."""
+    sector_size = 1 << 12
+    default_dir = os.path.join(os.path.expanduser('~'), '.cache', 'md1702-tools')
+    default_size = 64 << 20
+
+    def __init__(self, device_id, fw_version, path=None, max_size=None):
+        self.base = path if path is not None else self.default_dir
+        self.max_size = max_size if max_size is not None else self.default_size
+        self.key = re.sub('[^0-9A-Za-z.-]', '_', '%s_%s' % (device_id, fw_version))
+        self.path = os.path.join(self.base, self.key)
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        self.size = sum([size for name, size, mtime in self._entries()])
+
+    def _file(self, address):
+        return os.path.join(self.path, '%06x.bin' % address)
+
+    def _entries(self):
+        for root, dirs, files in os.walk(self.base):
+            for name in files:
+                if name.endswith('.bin'):
+                    name = os.path.join(root, name)
+                    st = os.stat(name)
+                    yield name, st.st_size, st.st_mtime
+
+    def get(self, address):
+        """Returns cached sector data as bytearray or None."""
+        name = self._file(address)
+        try:
+            with open(name, 'rb') as f:
+                data = bytearray(f.read())
+            os.utime(name, None)
+        except (IOError, OSError):
+            return None
+        if len(data) != self.sector_size:
+            self.invalidate(address)
+            return None
+        return data
+
+    def put(self, address, data):
+        assert address % self.sector_size == 0 and len(data) == self.sector_size
+        name = self._file(address)
+        self.invalidate(address)
+        with open(name + '.tmp', 'wb') as f:
+            f.write(bytes(bytearray(data)))
+        os.rename(name + '.tmp', name)
+        self.size += self.sector_size
+        if self.size > self.max_size:
+            self.evict()
+
+    def invalidate(self, address):
+        try:
+            os.remove(self._file(address))
+            self.size -= self.sector_size
+        except OSError:
+            pass
+
+    def evict(self):
+        """Removes least recently used sectors until 90% of the cap is used."""
+        entries = sorted(self._entries(), key=lambda e: e[2])
+        self.size = sum([size for name, size, mtime in entries])
+        for name, size, mtime in entries:
+            if self.size <= self.max_size * 9 // 10:
+                break
+            try:
+                os.remove(name)
+                self.size -= size
+            except OSError as e:
+                sys.stderr.write("Cannot remove cached sector %s: %s\n" % (name, e))
@@ -2,6 +2,7 @@
 
 from __future__ import print_function
 
+import mmap
 import sys
 from struct import *
 from array import array
@@ -31,7 +32,7 @@ class DM1702_messages(object):
                 length = min(data[start] + 1, self.tmpl_len)
                 self.messages += [ {'text' : DM1702_util.to_str(data, start+1, length)} ]
         else:
-            used = DM1702_util.get_data_bitmap(data[0:self.bmap_len])
+            used = DM1702_bitmap(data[0:self.bmap_len])
             if scan:
                 indexes = range(1,int((len(data)-self.data_start)/self.data_skip) + 1)
                 indexes = [x for x in indexes if x != 0xff]
@@ -103,26 +104,65 @@ class DM1702_codeplug(object):
                 results[mark] = int(start / DM1702_codeplug.sector_size)
         return results
 
+    @staticmethod
+    def from_file(filename):
+        """Loads a codeplug file, memory-mapped (copy on write) on Python 3."""
+        with open(filename, 'rb') as f:
+            if not python_v2:
+                try:
+                    return DM1702_codeplug(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY))
+                except (ValueError, EnvironmentError):
+                    pass # Empty or special files
+            return DM1702_codeplug(f.read())
+
     def __init__(self, data):
-        self.data=[ord(x) for x in data] if isinstance(data[0],str) else [x for x in data]
+        self.data = data if isinstance(data, (bytearray, mmap.mmap)) else bytearray(data)
         self.marks = self.get_data_map(self.data)
         self.channels = None
         self.zones = None
         self.scan_lists = None
 
-        self.load_contacts()
+        # Decoded on first access
+        self._contacts = None
+        self._btn_map = None
+        self._c_c_map = None
+        self._messages = {}
+
+    @property
+    def contacts(self):
+        if self._contacts is None:
+            cm = self.get_data('Contact_meta')
+            cd = self.get_data('Contact_data')
+            self._contacts = DM1702_contacts(cd, cm)
+            self._cp_contacts = len(self._contacts)
+        return self._contacts
+
+    @property
+    def btn_map(self):
+        if self._btn_map is None:
+            self._btn_map = self.get_cbc_map(self.get_data('Buttons'), False)
+        return self._btn_map
+
+    @property
+    def c_c_map(self):
+        if self._c_c_map is None:
+            self._c_c_map = self.get_cbc_map(self.get_data('Channel_contact'), True)
+        return self._c_c_map
+
+    def detach(self):
+        """Copies memory-mapped data to memory, e.g. before the file is overwritten."""
+        if isinstance(self.data, mmap.mmap):
+            self.data = bytearray(self.data)
 
     def get_block(self, bid):
         #print("Get block id=0x%02x, start = 0x%06x, end = 0x%06x" % (bid, bid * self.sector_size, (bid+1) * self.sector_size))
-        return self.data[bid * self.sector_size:(bid+1) * self.sector_size]
+        return DM1702_util.view(self.data, bid * self.sector_size, (bid+1) * self.sector_size)
 
     def set_block_data(self, bid, data, offset):
         start = bid * self.sector_size + offset
         #print("Set block id=0x%02x, start = 0x%06x, end = 0x%06x" % (bid, start, start+len(data)))
-        assert len(self.data[start:start+len(data)]) == len(data)
-        for i in range(0, len(data)):
-            self.data[start +i] = data[i]
-        #self.data[start:start+len(data)] == data
+        assert start + len(data) <= len(self.data)
+        self.data[start:start+len(data)] = bytearray(data)
 
     def get_data_size(self, block_ids):
         chains = DATA_ranges[block_ids]
@@ -132,16 +172,21 @@ class DM1702_codeplug(object):
         return total
 
     def get_data(self, block_ids):
+        """Returns a view of the data for single range blocks, a bytearray
+        joined from all the ranges otherwise."""
         chains = DATA_chains[block_ids]
         ranges = DATA_ranges[block_ids]
         assert len(ranges) == len(chains)
-        data= []
+        if len(ranges) == 1 and chains[0] in self.marks:
+            start = self.marks[chains[0]] * self.sector_size
+            return DM1702_util.view(self.data, start + min(ranges[0]), start + max(ranges[0]) + 1)
+        data = bytearray()
         for i in range(0, len(ranges)):
             if chains[i] not in self.marks:
                 if i == 0:
                     sys.stderr.write("Block with ID 0x%02x not found, returning empty data.\n" % chains[i])
                 #data += ([0xff] * (ranges[i][-1]-ranges[i][0]+1))
-                data += ([0xff] * (max(ranges[i])-min(ranges[i])+1))
+                data += b'\xff' * (max(ranges[i])-min(ranges[i])+1)
                 break
             else:
                 #data += self.get_block(self.marks[chains[i]])[ranges[i][0]:ranges[i][-1]+1]
@@ -163,7 +208,8 @@ class DM1702_codeplug(object):
             rmin = min(ranges[i])
             if chains[i] not in self.marks:
                 sys.stderr.write("Block with ID 0x%02x not found adding to the end (This won't work for CPS data file)!\n" % chains[i])
-                self.data += [0xff] * (self.sector_size-1) + [chains[i]]
+                self.detach()
+                self.data += b'\xff' * (self.sector_size-1) + bytearray([chains[i]])
                 self.marks = self.get_data_map(self.data)
             bid = self.marks[chains[i]]
             self.set_block_data(bid, data[skip:rlen+skip+1], rmin)
@@ -180,10 +226,13 @@ class DM1702_codeplug(object):
             if mt2 not in DATA_chains:
                 sys.stderr.write("Unknown message type %s, skipping.\n" % mtype)
             elif DATA_chains[mt2][0] in self.marks:
-                result[mtype] = DM1702_messages(self.get_data(mt2), mtype, deleted, self.contacts)
+                if (mtype, deleted) not in self._messages:
+                    self._messages[(mtype, deleted)] = DM1702_messages(self.get_data(mt2), mtype, deleted, self.contacts)
+                result[mtype] = self._messages[(mtype, deleted)]
         return result
 
     def get_cbc_map(self, mapping, ch_mode=True):
+        contacts = self.contacts
         data = []
         for i in range(0, int(len(mapping)/2)):
             if ch_mode:
@@ -196,10 +245,10 @@ class DM1702_codeplug(object):
             elif cidx == 0:
                 cid = None
                 contact = None
-            elif cidx <= len(self.contacts.clist):
+            elif cidx <= self._cp_contacts: # Only contacts stored in codeplug
                 #cid = float(self.contacts.clist[cidx-1])
                 #cstr = str(self.contacts.clist[cidx-1])
-                contact = self.contacts.clist[cidx-1]
+                contact = contacts.clist[cidx-1]
             else:
                 sys.stderr.write("Contact %c_%i does not exist, setting to None\n" % ('C' if ch_mode else 'B', i))
                 contact = None
@@ -238,12 +287,10 @@ class DM1702_codeplug(object):
         return mapping
 
     def load_contacts(self):
-        cm = self.get_data('Contact_meta')
-        cd = self.get_data('Contact_data')
-        self.contacts = DM1702_contacts(cd, cm)
-
-        self.btn_map = self.get_cbc_map(self.get_data('Buttons'), False)
-        self.c_c_map = self.get_cbc_map(self.get_data('Channel_contact'), True)
+        """Decodes contacts and their mappings, normally done on first access."""
+        self._contacts = None
+        self._btn_map = self.get_cbc_map(self.get_data('Buttons'), False)
+        self._c_c_map = self.get_cbc_map(self.get_data('Channel_contact'), True)
 
     def save_contacts(self):
         cmap, cdata, skipped = self.contacts.export_CP()
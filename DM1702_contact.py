@@ -4,9 +4,21 @@ from __future__ import print_function
 
 from struct import *
 from array import array
+from collections import Counter
+from itertools import compress
+import copy
+import heapq
+import os
+import re
+import struct
 import sys
 from DM1702_data_maps import *
 
+try:
+    intern_str = sys.intern
+except AttributeError: # Python 2
+    intern_str = intern
+
 callTypes = {
     'private' : 0x3,
     'group' : 0x4,
@@ -124,15 +136,20 @@ contactFormats = {
 }
 
 class DM1702_contact(object):
+    # Hundreds of thousands of contacts are kept in memory during imports,
+    # so they have no per-instance __dict__ and share country strings
+    __slots__ = ('call', 'name', 'cid', 'country', 'type')
     sort_by = callSorting['callSign']
     csv_idx = 0
     contact_len = 0x18
+    md_record = Struct('<2s16scLc')
+    md_fields = Struct('<2x16sxLx')
 
     def __init__(self, cid, call, name=None, country=None, ctype = None):
         self.call=call
         self.name=name
         self.cid=int(cid)
-        self.country=country
+        self.country=intern_str(country) if isinstance(country, str) else country
         if isinstance(ctype, int):
             self.type = ctype
         elif ctype in callTypes:
@@ -168,24 +185,38 @@ class DM1702_contact(object):
 #
     @staticmethod
     def from_MD_record(data):
-        call, tcid = unpack('<2x16sxLx', data)
+        return DM1702_contact.from_MD_fields(*DM1702_contact.md_fields.unpack(data))
+
+    @staticmethod
+    def from_MD_fields(call, tcid):
         call = call.decode(errors="ignore").split('\x00')[0]
         cid = tcid & 0xffffff
         ctype = (tcid >> 24) & 0xf
         #print(call, cid, ctype)
         return DM1702_contact(cid, call, ctype = ctype)
 
-    # This will be probably slow :-(
-    def cmp(self, other):
+    @staticmethod
+    def iter_MD_fields(data):
+        """Yields (call, type|id) of all whole contact records in data."""
+        rec = DM1702_contact.md_fields
+        size = len(data) - len(data) % rec.size
+        if hasattr(struct, 'iter_unpack'):
+            return rec.iter_unpack(memoryview(data)[:size])
+        data = bytes(bytearray(data[:size])) # Python 2
+        return (rec.unpack_from(data, pos) for pos in range(0, size, rec.size))
+
+    def sort_key(self):
+        """Key tuple for the selected sort order, used instead of cmp for sorting."""
         if DM1702_contact.sort_by == 'N' :
-            s1 = self.name
-            s2 = other.name
+            return (self.name or '',)
         elif DM1702_contact.sort_by == 'I' :
-            s1 = self.cid
-            s2 = other.cid
+            return (self.cid,)
         else:
-            s1 = "%s%i" % (self.country, self.cid)
-            s2 = "%s%i" % (other.country, other.cid)
+            return ("%s%i" % (self.country, self.cid),)
+
+    def cmp(self, other):
+        s1 = self.sort_key()
+        s2 = other.sort_key()
         return -1 if s1 < s2 else (1 if s1 > s2  else  0)
 
     def __str__(self):
@@ -198,7 +229,7 @@ class DM1702_contact(object):
         return self.cid
 
     def __lt__(self, other):
-        return self.cmp(other) < 0
+        return self.sort_key() < other.sort_key()
 
 #    def __gt__(self, other):
 #        return self.cmp(other) > 0
@@ -215,7 +246,13 @@ class DM1702_contact(object):
         return s1 == other
 
     def to_MD_record(self):
-        return pack('<2s16scLc', b'\xff\xff', str(self.call[:16]) if b"" == "" else bytes(self.call[:16],"utf-8"), b'\xff', (self.type << 24) | self.cid, b'\xff')
+        return self.md_record.pack(*self.MD_record_fields())
+
+    def pack_MD_record(self, buf, offset):
+        self.md_record.pack_into(buf, offset, *self.MD_record_fields())
+
+    def MD_record_fields(self):
+        return (b'\xff\xff', str(self.call[:16]) if b"" == "" else bytes(self.call[:16],"utf-8"), b'\xff', (self.type << 24) | self.cid, b'\xff')
         #return pack('<2x16sxLx', str(self.call[:16]) if b"" == "" else bytes(self.call[:16],"utf-8"), (self.type << 24) | self.cid)
 
     def to_cps_csv(self):
@@ -225,6 +262,103 @@ class DM1702_contact(object):
     def __repr__(self):
         return repr({ 'id' : self.cid, 'call' : self.call, 'type' : self.type })
 
+class DM1702_contact_filter(object):
+    """Selection of contacts during CSV import, all given criteria must match."""
+
+    def __init__(self, countries=None, prefixes=None, id_range=None, call_regex=None, heard=None):
+        self.countries = set([c.strip().upper() for c in countries]) if countries else None
+        self.prefixes = tuple(prefixes) if prefixes else None
+        self.id_range = id_range
+        self.call_regex = re.compile(call_regex, re.IGNORECASE) if call_regex else None
+        self.heard = heard
+
+    @staticmethod
+    def from_options(options):
+        """Creates a filter from --country=CZ,DE --prefix=230,262 --range=2300000-2309999
+        --call=REGEX --heard=FILE options, returns None if none is given."""
+        if not [x for x in ['country', 'prefix', 'range', 'call', 'heard'] if x in options]:
+            return None
+        id_range = None
+        if 'range' in options:
+            low, high = options['range'].split('-')
+            id_range = (int(low), int(high))
+        return DM1702_contact_filter(
+            options['country'].split(',') if 'country' in options else None,
+            options['prefix'].split(',') if 'prefix' in options else None,
+            id_range, options.get('call'),
+            DM1702_contact_filter.load_ids(options['heard']) if 'heard' in options else None)
+
+    @staticmethod
+    def load_ids(infile):
+        """Reads a set of DMR IDs, the first number on each line of a text/CSV file."""
+        ids = set()
+        with open(infile, 'r') as f:
+            for line in f:
+                m = re.match(r'\s*"?(\d+)', line)
+                if m:
+                    ids.add(int(m.group(1)))
+        return ids
+
+    def __call__(self, contact):
+        if self.heard is not None and contact.cid not in self.heard:
+            return False
+        if self.id_range is not None and not (self.id_range[0] <= contact.cid <= self.id_range[1]):
+            return False
+        if self.prefixes is not None and not str(contact.cid).startswith(self.prefixes):
+            return False
+        if self.countries is not None and (contact.country is None or contact.country.upper() not in self.countries):
+            return False
+        if self.call_regex is not None and not self.call_regex.search(contact.call):
+            return False
+        return True
+
+class DM1702_contact_usage(object):
+    """Ranks contacts by usefulness - pinned IDs first, then by how often the
+    ID appears in md1702-rec recordings (source or destination) and in SMS
+    messages, so that the limited contact slots are filled with used IDs."""
+    # File names created by md1702-rec (see recording.__str__), optionally prefixed
+    rec_name = re.compile(r'\d{4}-\d\d-\d\d_\d\d-\d\d-\d\d_[AB]_(\d+)_(?:TG|ALL)?(\d+)_(?:RX|TX)_Z')
+
+    def __init__(self):
+        self.counts = Counter()
+        self.pinned = set()
+
+    def add_recordings(self, path):
+        """Counts IDs from recording file names in a directory (or a single file)."""
+        names = os.listdir(path) if os.path.isdir(path) else [os.path.basename(path)]
+        for name in names:
+            m = self.rec_name.search(name)
+            if m:
+                self.counts[int(m.group(1))] += 1
+                self.counts[int(m.group(2))] += 1
+
+    def add_messages(self, messages):
+        """Counts IDs from DM1702_messages dicts ({'sent' : messages, ...})."""
+        for mtype in messages:
+            for m in messages[mtype].messages:
+                if 'call' in m:
+                    self.counts[m['call']] += 1
+
+    def score(self, contact):
+        return (contact.cid in self.pinned, self.counts.get(contact.cid, 0))
+
+    def __contains__(self, contact):
+        return contact.cid in self.pinned or contact.cid in self.counts
+
+    def select(self, candidates, slots, fill=False, exclude=()):
+        """Returns the best slots candidates in rank order, without fill only
+        pinned or used ones are selected. Candidates with an ID (see
+        DM1702_contact.__float__) in exclude, e.g. float_map of the contacts
+        being filled, and repeated IDs are skipped so no slot is wasted."""
+        seen = set(exclude)
+        def fresh():
+            for c in candidates:
+                fid = float(c)
+                if fid not in seen and (fill or c in self):
+                    seen.add(fid)
+                    yield c
+        return heapq.nlargest(slots, fresh(), key=self.score)
+
 class DM1702_contacts(object):
     max_internal_contacts = 800
 
@@ -234,14 +368,19 @@ class DM1702_contacts(object):
         self.str_map = {}
         self.int_map = {}
         self.float_map = {}
+        # Sorted call and ID indexes, appended keys are merged in on next use
+        self.str_sorted = []
+        self.float_sorted = []
+        self.pending = []
         if contact_data is not None and contact_map is not None:
             self.import_CP(contact_data, contact_map)
 
     def append(self, contact):
         idx = len(self.clist)
-        if float(contact) in self.float_map: #Duplicate contact DMR ID not allowed
+        fid = float(contact)
+        if fid in self.float_map: #Duplicate contact DMR ID not allowed
             return
-        elif str(contact) in self.str_map:
+        elif contact.call in self.str_map:
             if self.clist[self.str_map[str(contact)]] == contact:
                 return #Duplicate contact entry not allowed
             elif float(contact) not in self.float_map:
@@ -257,14 +396,34 @@ class DM1702_contacts(object):
                     if self.clist[self.str_map[str(contact)]] == contact:
                        return #If already inserted, skip it
         self.clist.append(contact)
-        self.str_map[str(contact)] = self.int_map[int(contact)] = self.float_map[float(contact)] = idx
+        self.str_map[contact.call] = self.int_map[contact.cid] = self.float_map[fid] = idx
+        self.pending.append(contact)
+
+    def _merge_pending(self):
+        if self.pending:
+            # Timsort merges the sorted index and the sorted new run in linear time
+            self.str_sorted += sorted([str(c) for c in self.pending])
+            self.str_sorted.sort()
+            self.float_sorted += sorted([float(c) for c in self.pending])
+            self.float_sorted.sort()
+            self.pending = []
+
+    def sorted_calls(self):
+        """Returns all calls in alphabetic order (the 0x100 index order)."""
+        self._merge_pending()
+        return self.str_sorted
+
+    def sorted_ids(self):
+        """Returns all IDs (float, see DM1702_contact) in numeric order (the 0x740 index order)."""
+        self._merge_pending()
+        return self.float_sorted
 
     def sort(self, by=None):
         self.str_map = {}
         self.int_map = {}
         self.float_map = {}
         if by is not None: DM1702_contact.set_sort(by)
-        self.clist.sort()
+        self.clist.sort(key=DM1702_contact.sort_key)
         for idx in range(0,len(self.clist)) :
             ct = self.clist[idx]
             self.str_map[str(ct)] = self.int_map[int(ct)] = self.float_map[float(ct)] = idx
@@ -290,25 +449,12 @@ class DM1702_contacts(object):
 
     def import_CP(self, contact_data, contact_map):
         cnt, gr_calls, all_call_ind = unpack("<HHB11x", bytes(bytearray(contact_map[0:0x10])))
-        bmap=DM1702_util.get_data_bitmap(contact_map[0x10:0x74])
+        bmap=DM1702_bitmap(contact_map[0x10:0x74])
         indices1 = unpack("<800H", bytes(bytearray(contact_map[0x100:0x740])))
         indices1 = [ (x & 0xfff) for x in indices1 if x != 0xF000]
-        i = c = 0
         #print("Count: %i, group: %i, All: %i, Alloc: %i, Ind: %i" % (cnt, gr_calls, all_call_ind, bmap.count(True), len(indices1)))
-        ##Previous version of code checking indices instead of bitmap
-        #for ent in range(0, cnt):
-        #    if (ent+1) in indices1:
-        #        cont = DM1702_contact.from_MD_record(bytes(\
-        #            bytearray(contact_data[i:i+DM1702_contact.contact_len])))
-        #        self.append(cont)
-        #        c += 1
-        #    i += DM1702_contact.contact_len
-        for ent in range(0, len(bmap)):
-            if bmap[ent]:
-                cont = DM1702_contact.from_MD_record(bytes(\
-                    bytearray(contact_data[i:i+DM1702_contact.contact_len])))
-                self.append(cont)
-            i += DM1702_contact.contact_len
+        for fields in compress(DM1702_contact.iter_MD_fields(contact_data), bmap):
+            self.append(DM1702_contact.from_MD_fields(*fields))
 
     def export_CP(self):
         contact_data = []
@@ -328,7 +474,7 @@ class DM1702_contacts(object):
         contact_map += b'\x00\x00\xff\xff\xff\xff\xfe' + (b'\xff' * (0x100-0x7d))
         skipped = skipped2 = 0
         #Add Alphabetic indices
-        for sid in sorted(self.str_map):
+        for sid in self.sorted_calls():
             if self.str_map[sid] < self.max_internal_contacts:
                 ctact = self.clist[self.str_map[sid]]
                 item = (self.str_map[sid]+1) | (ctact.type << 12)
@@ -338,7 +484,7 @@ class DM1702_contacts(object):
         contact_map += b'\x00\xf0' * int((0x740 - len(contact_map))/2)
 
         #Add Numeric indices
-        for sid in sorted(self.float_map):
+        for sid in self.sorted_ids():
             if self.float_map[sid] < self.max_internal_contacts:
                 ctact = self.clist[self.float_map[sid]]
                 item = (self.float_map[sid]+1) | (ctact.type << 12)
@@ -348,17 +494,41 @@ class DM1702_contacts(object):
         assert skipped == skipped2
 
         contact_map += b'\x00\xf0' * int((0xd80 - len(contact_map))/2)
-        contact_map = [x for x in contact_map]
+        contact_map = bytearray(contact_map)
 
-        contact_data = []
-        for c in self.clist:
-            contact_data += c.to_MD_record()
+        contact_data = bytearray(len(self.clist) * DM1702_contact.contact_len)
+        for idx, c in enumerate(self.clist):
+            c.pack_MD_record(contact_data, idx * DM1702_contact.contact_len)
         return contact_map, contact_data, skipped
 
-    def load(self, infile, ftype="auto"):
+    def extend(self, contacts):
+        """Appends copies of contacts (append may relabel duplicate calls)."""
+        for contact in contacts:
+            self.append(copy.copy(contact))
+
+    def load(self, infile, ftype="auto", accept=None, limit=None):
+        for contact in self.read_selected(infile, ftype, accept, limit):
+            self.append(contact)
+
+    @staticmethod
+    def read_selected(infile, ftype="auto", accept=None, limit=None):
+        """Streams contacts from a CSV file keeping only the ones accepted by
+        the filter, with limit only the first ones in the selected sort order
+        are kept (in a bounded heap), so the memory use does not depend on
+        the size of the input file."""
+        contacts = DM1702_contacts.read_csv(infile, ftype)
+        if accept is not None:
+            contacts = (c for c in contacts if accept(c))
+        if limit is not None:
+            contacts = heapq.nsmallest(limit, contacts, key=DM1702_contact.sort_key)
+        return contacts
+
+    @staticmethod
+    def read_csv(infile, ftype="auto"):
+        """Yields a new DM1702_contact for each row of a CSV contact file."""
         import csv
         with open(infile, 'r') as f:
-            if ftype is "auto":
+            if ftype == "auto":
                 l=f.readline()
                 sep = ';' if ';' in l else (',' if ',' in l else '@')
                 f.seek(0)
@@ -371,9 +541,11 @@ class DM1702_contacts(object):
                        if contactFormats[fmt]['seek'] is not None and l.index(contactFormats[fmt]['fields'][0]) != 0:
                            f.seek(contactFormats[fmt]['seek'])
                        break
-            if ftype is "auto":
+            elif ftype in contactFormats:
+                sep = contactFormats[ftype]['delimiter']
+            if ftype not in contactFormats:
                 raise Exception('Input contact file format not recognized')
-            cf = contactFormats[fmt]
+            cf = contactFormats[ftype]
             csv_reader = csv.DictReader(f, delimiter=sep)
             for row in csv_reader:
                 #print(row)
@@ -393,7 +565,7 @@ class DM1702_contacts(object):
                     name = row[cf['name']]
                 if cf['country'] is not None and cf['country'] in row and row[cf['country']] != '':
                     country = row[cf['country']]
-                self.append(DM1702_contact(cid, cs, name, country, calltype))
+                yield DM1702_contact(cid, cs, name, country, calltype)
 
     def save(self, outfile, ftype):
         import csv
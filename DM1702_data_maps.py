@@ -1,5 +1,9 @@
 # -*- coding: utf-8 -*-
 
+import sys
+
+python_v2 = (sys.version_info[0] == 2)
+
 DATA_map = {
 #    0x00: 'FW_info',
 #    0x01: 'Meta',
@@ -70,16 +74,16 @@ DATA_ranges = {
 }
 
 class DM1702_util(object):
+    # Expanded bits (LSB first) of every byte value, set bits are True
+    bitmap_table = [tuple([(c >> j) & 0x1 == 0x1 for j in range(8)]) for c in range(256)]
+
     @staticmethod
-    def get_data_bitmap(data, inverted=False):
-        odata = []
-        bit = 0x1 if inverted else 0x0
-        for c in data:
-            if isinstance(c,str):
-                c = ord(c)
-            for j in range(8):
-                odata.append(((c >> j) & 0x1 == bit))
-        return odata
+    def view(data, start, end):
+        """Returns data[start:end] without copying where possible (memoryview
+        items are not ints in Python 2, a copy is returned there)."""
+        if python_v2:
+            return data[start:end]
+        return memoryview(data)[start:end]
 
     @staticmethod
     def pad_data(data, plen):
@@ -106,6 +110,63 @@ class DM1702_util(object):
             sub = DM1702_util.dtrim(sub)
         return "".join([chr(c) for c in sub])
 
+    @staticmethod
+    def pop_options(argv):
+        """Removes --name[=value] options from argv (in place) and returns
+        them as a dict, so positional command parsing stays unchanged."""
+        options = {}
+        for arg in argv[1:]:
+            if arg.startswith('--') and len(arg) > 2:
+                name, sep, value = arg[2:].partition('=')
+                options[name] = value if sep else True
+        argv[1:] = [arg for arg in argv[1:] if not (arg.startswith('--') and len(arg) > 2)]
+        return options
+
     @staticmethod
     def csv_esc(in_str):
         return '"' + str(in_str).replace('"','""') + '"'
+
+class DM1702_bitmap(object):
+    """Allocation bitmap kept as an integer bitset.
+
+    Slots are numbered from the LSB of the first byte, only the lowest width
+    bits of each byte are used (recording maps use 7). The radio clears bits
+    when allocating, so a slot is True (used) when its bit is cleared, unless
+    the bitmap is inverted."""
+    bin_tables = {}
+
+    def __init__(self, data, inverted=False, width=8):
+        data = bytearray(data)
+        self.width = width
+        self.inverted = inverted
+        self.size = len(data) * width
+        if width not in DM1702_bitmap.bin_tables:
+            DM1702_bitmap.bin_tables[width] = ['{0:0{1}b}'.format(c & ((1 << width) - 1), width) for c in range(256)]
+        table = DM1702_bitmap.bin_tables[width]
+        raw = int(''.join([table[c] for c in reversed(data)]) or '0', 2)
+        self.bits = raw if inverted else raw ^ ((1 << self.size) - 1)
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += self.size
+        if idx < 0 or idx >= self.size:
+            raise IndexError('bitmap index out of range')
+        return (self.bits >> idx) & 0x1 == 0x1
+
+    def __iter__(self):
+        """Yields True/False for every slot."""
+        table = DM1702_util.bitmap_table
+        bits, width, mask = self.bits, self.width, (1 << self.width) - 1
+        for shift in range(0, self.size, width):
+            for used in table[(bits >> shift) & mask][:width]:
+                yield used
+
+    def count(self, value=True):
+        used = bin(self.bits).count('1')
+        return used if value else self.size - used
+
+    def to_list(self):
+        return list(self)
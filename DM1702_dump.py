@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+
+import json
+import mmap
+import os
+import sys
+import time
+import zlib
+
+class DM1702_dump(object):
+    """Resumable SPI flash dump of sectors in range(start, end, sector_size).
+
+    The output file is preallocated and memory mapped, so sectors may be
+    stored in any order. Completed sectors are recorded with their CRC32 in
+    a <filename>.ckpt JSON sidecar, which is saved every few sectors and when
+    closed unfinished. Opening the same dump again skips the checkpointed
+    sectors whose data in the file still match their CRC. The sidecar is
+    removed once the dump is complete."""
+    retries = 5
+    backoff = 1.0 # seconds before the first retry, doubled for each next one
+    save_every = 16 # sectors between checkpoint saves
+
+    def __init__(self, filename, start, end, sector_size=1 << 12):
+        self.filename = filename
+        self.ckpt = filename + '.ckpt'
+        self.sector_size = sector_size
+        self.header = {'start' : start, 'end' : end, 'sector_size' : sector_size}
+        self.sectors = list(range(start, end, sector_size))
+        self.size = len(self.sectors) * sector_size
+        self.done = {}
+        self.unsaved = 0
+        saved = self._load()
+        resume = saved is not None and os.path.isfile(filename) and os.path.getsize(filename) == self.size
+        self.file = open(filename, 'r+b' if resume else 'w+b')
+        self.file.truncate(self.size)
+        self.map = mmap.mmap(self.file.fileno(), self.size) if self.size else None
+        if resume:
+            for address, crc in saved.items():
+                if self.crc(self.sector(address)) == crc:
+                    self.done[address] = crc
+
+    def _load(self):
+        """Returns {sector address: CRC32} of a checkpoint of the same dump or None."""
+        try:
+            with open(self.ckpt, 'r') as f:
+                ckpt = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        if dict([(k, ckpt.get(k)) for k in self.header]) != self.header:
+            sys.stderr.write("Checkpoint %s is for a different range, starting over\n" % self.ckpt)
+            return None
+        return dict([(int(k, 16), v) for k, v in ckpt['done'].items()])
+
+    @staticmethod
+    def crc(data):
+        return zlib.crc32(bytes(bytearray(data))) & 0xffffffff
+
+    def offset(self, address):
+        return (address - self.sectors[0]) // self.sector_size * self.sector_size
+
+    def sector(self, address):
+        pos = self.offset(address)
+        return self.map[pos:pos+self.sector_size]
+
+    def pending(self):
+        """Returns addresses of sectors not read yet."""
+        return [address for address in self.sectors if address not in self.done]
+
+    def put(self, address, data):
+        pos = self.offset(address)
+        self.map[pos:pos+self.sector_size] = bytes(bytearray(data))
+        self.done[address] = self.crc(data)
+        self.unsaved += 1
+        if self.unsaved >= self.save_every:
+            self.save()
+
+    def fetch(self, read, address, length=None):
+        """Returns read(address) of length (a sector by default), failed reads
+        are retried with exponential backoff."""
+        length = self.sector_size if length is None else length
+        for attempt in range(self.retries + 1):
+            try:
+                data = read(address)
+                if len(data) == length:
+                    return data
+                error = 'got %i of %i' % (len(data), length)
+            except Exception as e: # USBError, timeout or an invalid reply
+                error = e
+            if attempt < self.retries:
+                delay = self.backoff * (1 << attempt)
+                sys.stderr.write("\nReading sector 0x%06x failed (%s), retrying in %.0f s\n" % (address, error, delay))
+                time.sleep(delay)
+        raise Exception("Reading sector 0x%06x failed %i times (%s)" % (address, self.retries + 1, error))
+
+    def save(self):
+        """Flushes the data and records the completed sectors."""
+        if self.map is not None:
+            self.map.flush()
+        ckpt = dict(self.header)
+        ckpt['done'] = dict([('%06x' % k, v) for k, v in self.done.items()])
+        with open(self.ckpt + '.tmp', 'w') as f:
+            json.dump(ckpt, f, sort_keys=True)
+        if os.path.exists(self.ckpt):
+            os.remove(self.ckpt)
+        os.rename(self.ckpt + '.tmp', self.ckpt)
+        self.unsaved = 0
+
+    def close(self):
+        """Closes the dump, returns True if all sectors were stored."""
+        complete = not self.pending()
+        if complete:
+            if self.map is not None:
+                self.map.flush()
+            if os.path.exists(self.ckpt):
+                os.remove(self.ckpt)
+        else:
+            self.save()
+        if self.map is not None:
+            self.map.close()
+        self.file.close()
+        return complete
@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+
+from array import array
+from collections import Counter, deque
+import struct
+import time
+
+from DM1702_DFU import DM1702_transport, DM1702_crc16, Deltas, DFUComm, Requests, Statuses, Versions
+
+def to_bytes(data):
+    """Protocol constants are str, encoded 1:1 to bytes in Python 3."""
+    return data.encode('latin-1') if not isinstance(data, (bytes, bytearray, array)) else data
+
+class DM1702_sim(DM1702_transport):
+    """Protocol level simulator of a radio backed by a SPI flash image, used
+    in place of a USB device by DM1702_DFU (DM1702_DFU(DM1702_sim(), 0)).
+
+    Implements the program mode (PSEARCH, PASSSTA, SYSINFO, V, R, W, G, T and
+    NEXT requests, SPI USB mode selection) and, when created with
+    bootloader=True, the firmware upgrade flow (R, M, E and stage 1 and 2
+    XMODEM transfers). Latency (in seconds) is added to every transfer and
+    requests longer than chunk_size (model default) are rejected. Handled
+    requests, USB transfers (writes and reads) and payload bytes are counted
+    in stats."""
+    flash_size = 1 << 24
+    spi_ranges = {
+        'Voices' : (0x900000, 0x9fffff),
+        'HZKFont' : (0x700000, 0x8fffff),
+        'Unknown1' : (0x0cf000, 0x0cffff),
+        'Recordings' : (0x186000, 0x3fffff),
+        'Settings' : (0x001000, 0x0c8fff),
+        'Logo' : (0x0c9000, 0x0ce00f),
+        'CSVContacts' : (0x400000, 0x6fffff),
+    }
+    info = {
+        'FWVersion' : 'V02.02.022',
+        'RefDate' : '2019-06-01',
+        'DataFormat' : 'V1.0',
+        'GPSFormat' : 'V1.0',
+        'CPSFormat' : 'V02.02',
+    }
+
+    def __init__(self, image=None, model='DMR1702', latency=0.0, chunk_size=None,
+                 device_id=b'\x12\x34\x56\x78', bootloader=False, firmware=None):
+        self.flash = bytearray(image) if image is not None else bytearray(b'\xff' * self.flash_size)
+        self.firmware = bytearray(firmware) if firmware is not None else bytearray(b'\xff' * (1 << 20))
+        self.custom = bytearray(b'\xff' * 0x30)
+        self.model = model
+        self.latency = latency
+        self.chunk_size = chunk_size if chunk_size is not None else Deltas[model]
+        self.device_id = bytearray(device_id)
+        self.mode = 'bootloader' if bootloader else 'normal'
+        self.spi_mode = False
+        self.time = None
+        self.fw_header = None
+        self.fw_blocks = 0
+        self.stats = Counter()
+        self._state = None
+        self._buffer = bytearray()
+        self._replies = deque()
+
+    def _delay(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _reply(self, data):
+        data = bytearray(to_bytes(data))
+        for pos in range(0, len(data), self.packet_size):
+            self._replies.append(data[pos:pos+self.packet_size])
+
+    def read(self, size, timeout=None):
+        self._delay()
+        self.stats['reads'] += 1
+        if not self._replies:
+            raise IOError('Operation timed out')
+        data = self._replies.popleft()
+        if len(data) > size:
+            self._replies.appendleft(data[size:])
+            data = data[:size]
+        return array('B', data)
+
+    def write(self, data):
+        self._delay()
+        self.stats['writes'] += 1
+        data = bytearray(to_bytes(data))
+        if self.mode == 'bootloader':
+            self._bootloader(data)
+        else:
+            self._program(data)
+        return len(data)
+
+    def _frame(self, data):
+        """Parses a [command, 3 address bytes, length] request header."""
+        hlen = 6 if self.model == 'DM1702S' else 5
+        length = data[4] + (data[5] << 8 if hlen == 6 else 0)
+        return data[1:4], length, data[hlen:]
+
+    def _program(self, data):
+        text = bytes(data)
+        self.stats[chr(data[0]) if data else ''] += 1
+        if text == Requests['NEXT']:
+            self._reply(Statuses['OK'])
+        elif text == to_bytes(Requests['SEARCH']):
+            self._reply(Statuses['OK'] + self.model)
+        elif text == to_bytes(Requests['PCHECK']):
+            self._reply(Statuses['sPasswordSettingOK'])
+        elif text in [to_bytes(Requests['SINFO']), to_bytes(Requests['TIMESET']), to_bytes(self.model)]:
+            self._reply(Statuses['OK'])
+        elif text == Requests['MSEL']:
+            pass
+        elif text == to_bytes(Requests['PCMODE']):
+            self.spi_mode = True
+            self._reply(Statuses['sPCM8FF'])
+        elif text[:1] == b'V' and len(data) == 5:
+            self._reply(bytearray(b'V\x00') + self._verify(data[4], data[3], (data[1] << 8) | data[2]))
+        elif text[:1] in [b'R', b'W', b'G', b'T'] and len(data) >= 5:
+            addr, length, payload = self._frame(data)
+            if length > self.chunk_size and text[:1] != b'T':
+                self._reply(Statuses['Error'])
+            elif text[:1] == b'R':
+                start = addr[0] | (addr[1] << 8) | (addr[2] << 16)
+                chunk = self.flash[start:start+length]
+                self.stats['bytes_read'] += length
+                self._reply(bytearray(b'W') + data[1:len(data)] + chunk + b'\xff' * (length - len(chunk)))
+            elif text[:1] == b'W':
+                start = addr[0] | (addr[1] << 8) | (addr[2] << 16)
+                self.flash[start:start+length] = payload[:length]
+                self.stats['bytes_written'] += length
+                self._reply(Statuses['OK'])
+            elif text[:1] == b'G':
+                start = (addr[0] << 12) | (addr[1] << 8) | addr[2]
+                self.stats['bytes_read'] += length
+                self._reply(bytearray(b'S') + data[1:len(data)] + self.firmware[start:start+length])
+            else:
+                self.time = payload[:length]
+                self._reply(Statuses['OK'])
+        else:
+            self._reply(Statuses['Error'])
+
+    def _verify(self, command, rlength, addr):
+        """Returns V reply payload with its length byte."""
+        names = dict([(v, k) for k, v in Versions.items()])
+        name = names.get(command)
+        if name in self.spi_ranges:
+            payload = struct.pack('<LL', *self.spi_ranges[name])
+        elif name in self.info:
+            payload = to_bytes(self.info[name])
+        elif name == 'DeviceID':
+            payload = self.device_id if self.spi_mode else b''
+        elif name == 'Custom':
+            payload = self.custom[addr:addr+rlength]
+        else:
+            payload = b''
+        return bytearray([len(payload)]) + payload
+
+    def _bootloader(self, data):
+        text = bytes(data)
+        if self._state in ['header', 'block']:
+            self._buffer += data
+            if len(self._buffer) >= (130 if self._state == 'header' else 1026):
+                self._state += '_crc'
+            return
+        if self._state in ['header_crc', 'block_crc']:
+            payload = self._buffer[2:]
+            ok = DM1702_crc16(payload).digest() == text[:2]
+            if self._state == 'header_crc':
+                self.fw_header = self._buffer
+                self._reply(DFUComm['OKContinue'] if ok else '\x15')
+            else:
+                self.stats['fw_blocks'] += 1
+                ok = ok and self._buffer[0] == (self.fw_blocks + 1) & 0xff and self._buffer[1] == 0xff - self._buffer[0]
+                if ok:
+                    pos = 0x8000 + self.fw_blocks * 1024
+                    self.firmware[pos:pos+1024] = payload
+                    self.fw_blocks += 1
+                self._reply(DFUComm['OK'] if ok else '\x15')
+            self._state = None
+            self._buffer = bytearray()
+            return
+        self.stats[chr(data[0]) if data else ''] += 1
+        if text == to_bytes(DFUComm['Ready']):
+            self._reply(DFUComm['OK'])
+        elif text[:1] == b'M':
+            self._reply(DFUComm['ModelReply'])
+        elif text == to_bytes(DFUComm['OK']):
+            self._reply(DFUComm['VersionPrefix'] + '2')
+        elif text[:1] == b'E':
+            self.firmware[0x8000:] = b'\xff' * (len(self.firmware) - 0x8000)
+            self.fw_blocks = 0
+            self._reply(DFUComm['OK'])
+        elif text == to_bytes(DFUComm['EraseType']):
+            self._reply(DFUComm['Continue'])
+        elif text in [to_bytes(DFUComm['Stage1']), to_bytes(DFUComm['Stage2'])]:
+            self._state = 'header' if text == to_bytes(DFUComm['Stage1']) else 'block'
+            self._reply(DFUComm['Continue'])
+        elif text == to_bytes(DFUComm['Reboot']):
+            self.mode = 'normal'
+            self._reply(DFUComm['Continue'])
+        else:
+            self._reply('\x15')
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+
+from array import array
+import atexit
+import sys
+from collections import Counter
+from timeit import default_timer
+
+from DM1702_DFU import DM1702_transport, Requests
+
+def transfer_bucket(value, limits):
+    """Returns the first limit not lower than value, None above all limits."""
+    for limit in limits:
+        if value <= limit:
+            return limit
+    return None
+
+class timed_transport(DM1702_transport):
+    """Transport proxy recording size and duration of every USB transfer."""
+
+    def __init__(self, transport, stats):
+        self.transport = transport
+        self.stats = stats
+        self.packet_size = transport.packet_size
+
+    @property
+    def default_timeout(self):
+        return self.transport.default_timeout
+
+    @default_timeout.setter
+    def default_timeout(self, timeout):
+        self.transport.default_timeout = timeout
+
+    def write(self, data):
+        start = default_timer()
+        result = self.transport.write(data)
+        self.stats.transfer('out', len(data), default_timer() - start)
+        return result
+
+    def read(self, size, timeout=None):
+        start = default_timer()
+        try:
+            data = self.transport.read(size, timeout)
+        except IOError:
+            self.stats.transfer('in', 0, default_timer() - start, True)
+            raise
+        self.stats.transfer('in', len(data), default_timer() - start)
+        return data
+
+class DM1702_stats(object):
+    """Counts and times DM1702_DFU requests per command (send_text, send_data,
+    read_reply and read calls, a read() reply is accounted to the request
+    its code answers, as pipelined READs are followed by NEXT before their
+    replies arrive, other replies to the last command sent), with histograms of bytes and latency per USB transfer and the
+    number of extra reads read() needed to assemble a reply.
+
+    Installed by DM1702_DFU.enable_stats, which rebinds the instrumented
+    methods of that instance only, so there is no cost when disabled."""
+    size_limits = [1 << i for i in range(13)]
+    latency_limits = [0.1, 0.25, 0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 5000] # ms
+    methods = ['send_text', 'send_data', 'read_reply', 'read']
+    names = dict([(v if isinstance(v, bytes) else v.encode('latin-1'), k)
+                  for k, v in Requests.items() if len(v) > 1 or not v.isalpha()])
+    # read() reply codes and the requests they answer
+    replies = {Requests['WRITE'] : Requests['READ'], Requests['SET'] : Requests['GET'], Requests['VERIFY'] : Requests['VERIFY']}
+
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.calls = {}
+        self.transfers = Counter()
+        self.sizes = Counter()
+        self.latencies = Counter()
+        self.extra_reads = 0
+        self.command = None
+        atexit.register(self.report)
+
+    @classmethod
+    def label(cls, command):
+        """Returns name of a request (NEXT, SEARCH, ...), a text request or
+        its command letter, DATA for payload (XMODEM blocks and CRCs)."""
+        if isinstance(command, int):
+            command = bytearray([command])
+        elif not isinstance(command, (bytes, bytearray, array)):
+            command = command.encode('latin-1')
+        if len(command) > 8:
+            return 'DATA'
+        text = bytes(bytearray(command))
+        if text in cls.names:
+            return cls.names[text]
+        if text[:1].isalpha():
+            printable = all([0x20 <= c < 0x7f for c in bytearray(text)])
+            return text.decode('latin-1') if printable and len(text) > 1 else text[:1].decode('latin-1')
+        return '0x%02x' % bytearray(text)[0] if len(text) == 1 else 'DATA'
+
+    def install(self, dfu):
+        dfu._transport = timed_transport(dfu._transport, self)
+        for name in self.methods:
+            setattr(dfu, name, self._timed(name, getattr(dfu, name)))
+
+    def _timed(self, name, method):
+        stats = self
+        sending = name.startswith('send')
+        def timed(*args, **kwargs):
+            if sending:
+                stats.command = stats.label(args[0])
+            reads = stats.transfers['in']
+            command = stats.command
+            start = default_timer()
+            try:
+                result = method(*args, **kwargs)
+                if name == 'read' and result[0] in stats.replies:
+                    command = stats.label(stats.replies[result[0]])
+                return result
+            finally:
+                elapsed = default_timer() - start
+                entry = stats.calls.setdefault((name, command), [0, 0.0])
+                entry[0] += 1
+                entry[1] += elapsed
+                if name == 'read':
+                    stats.extra_reads += max(0, stats.transfers['in'] - reads - 1)
+        return timed
+
+    def transfer(self, direction, size, elapsed, failed=False):
+        self.transfers[direction] += 1
+        self.transfers[direction + '_bytes'] += size
+        if failed:
+            self.transfers[direction + '_failed'] += 1
+        self.sizes[(direction, transfer_bucket(size, self.size_limits))] += 1
+        self.latencies[(direction, transfer_bucket(elapsed * 1000, self.latency_limits))] += 1
+
+    def summary(self):
+        """Returns the collected numbers as a dict (JSON serializable)."""
+        return {
+            'calls' : [{'method' : name, 'command' : command, 'count' : count, 'seconds' : seconds}
+                       for (name, command), (count, seconds) in sorted(self.calls.items(), key=lambda e: (e[0][0], str(e[0][1])))],
+            'transfers' : dict(self.transfers),
+            'extra_reads' : self.extra_reads,
+            'bytes_histogram' : self._histogram(self.sizes, self.size_limits),
+            'latency_ms_histogram' : self._histogram(self.latencies, self.latency_limits),
+        }
+
+    @staticmethod
+    def _histogram(counts, limits):
+        """Returns [[upper limit or None, transfers out, transfers in], ...]."""
+        return [[limit, counts[('out', limit)], counts[('in', limit)]] for limit in limits + [None]
+                if counts[('out', limit)] or counts[('in', limit)]]
+
+    def format(self):
+        summary = self.summary()
+        t = summary['transfers']
+        lines = ['DFU statistics: %i transfers out (%i bytes), %i in (%i bytes, %i failed), %i extra reads in read()' %
+                 (t.get('out', 0), t.get('out_bytes', 0), t.get('in', 0), t.get('in_bytes', 0), t.get('in_failed', 0), summary['extra_reads']),
+                 '  %-12s %-8s %8s %10s %8s' % ('call', 'command', 'count', 'total ms', 'avg ms')]
+        for c in summary['calls']:
+            lines.append('  %-12s %-8s %8i %10.1f %8.3f' % (c['method'], c['command'], c['count'], c['seconds'] * 1000, c['seconds'] * 1000 / c['count']))
+        for title, unit, key in [('bytes per transfer', 'B', 'bytes_histogram'), ('latency per transfer', 'ms', 'latency_ms_histogram')]:
+            lines.append('  %-22s %8s %8s' % (title, 'out', 'in'))
+            for limit, out, inp in summary[key]:
+                lines.append('  %-22s %8i %8i' % (('<= %g %s' % (limit, unit)) if limit is not None else 'more', out, inp))
+        return '\n'.join(lines)
+
+    def report(self):
+        """Passes the summary to the callback or prints it to stderr, called
+        at exit."""
+        if self.callback is not None:
+            self.callback(self.summary())
+        elif self.transfers:
+            sys.stderr.write(self.format() + '\n')
@@ -0,0 +1,268 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+# Copyright 2019 Pavel Moravec
+
+# This tool measures performance of the MD1702 tools internals, so that
+# changes to the hot paths can be compared against previous implementations.
+
+from __future__ import print_function
+
+import json
+import os.path
+import shutil
+import sys
+import tempfile
+import time
+from timeit import default_timer
+
+from DM1702_DFU import DM1702_DFU, DM1702_crc16, Deltas
+from DM1702_data_maps import DATA_map, DM1702_util
+from DM1702_sim import DM1702_sim
+import DM1702_contact as contact_module
+import md1702_dfu
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+cpu_time = getattr(time, 'process_time', None) or time.clock
+
+verbose_err = True
+options = {}
+
+def usage():
+    print("""
+Usage: md1702-bench <command> <arguments>
+
+Compare CRC16-XMODEM implementations used for firmware upgrade (1 MB by default)
+    md1702-bench crc [size_in_bytes]
+
+Compare memory used by contacts loaded from a CSV file (e.g. full dmrid list)
+with and without the compact contact representation (Python 3 only)
+    md1702-bench contacts <contacts.csv>
+
+Measure DFU operations (SPI read/write, codeplug map, codeplug read/write and
+firmware upgrade) of both radio models against the simulated radio
+    md1702-bench dfu [options]
+
+Options of the dfu command:
+    --latency=MS    USB round trip latency of the simulated radio (default 1)
+    --size=KIB      amount of SPI data read and written (default 64)
+    --window=N      SPI read requests kept in flight (default 1)
+    --json=FILE     store the results (with date and settings) to FILE
+""")
+
+def crc16_xmodem_legacy(data, crc=0x0000):
+    """Per-bit implementation used before the table based DM1702_crc16."""
+    msb = crc >> 8
+    lsb = crc & 255
+    for c in data:
+        if (type(c) == type('c')): # Python 3
+            c = ord(c)
+        x = c ^ msb
+        x ^= (x >> 4)
+        msb = (lsb ^ (x >> 3) ^ (x << 4)) & 255
+        lsb = (x ^ (x << 5)) & 255
+    return chr(msb) + chr(lsb)
+
+def timed(func, *args):
+    start = default_timer()
+    result = func(*args)
+    return result, default_timer() - start
+
+def bench_crc(size=1 << 20):
+    data = bytes(bytearray([(i * 7 + (i >> 8)) & 0xff for i in range(size)]))
+    ref, t_ref = timed(crc16_xmodem_legacy, data)
+    print("%-24s %8.3f s  %8.2f MB/s" % ('legacy per-bit', t_ref, size / t_ref / 1e6))
+    for name, use_binascii in [('table lookup', False), ('binascii.crc_hqx', True)]:
+        DM1702_crc16.use_binascii = use_binascii
+        def blocks():
+            crc = DM1702_crc16()
+            view = memoryview(data)
+            for pos in range(0, size, 1024):
+                crc.update(view[pos:pos+1024])
+            return crc.digest()
+        result, t = timed(blocks)
+        ok = result == bytes(bytearray([ord(c) for c in ref]))
+        print("%-24s %8.3f s  %8.2f MB/s  %6.1fx %s" % (name, t, size / t / 1e6, t_ref / t, 'OK' if ok else 'MISMATCH'))
+    DM1702_crc16.use_binascii = True
+
+class legacy_contact(object):
+    """Contact with a per-instance __dict__ and no string sharing,
+    as stored before DM1702_contact got __slots__."""
+    def __init__(self, cid, call, name=None, country=None, ctype=None):
+        self.call = call
+        self.name = name
+        self.cid = int(cid)
+        self.country = country
+        self.type = ctype
+
+def load_traced(infile, cls):
+    saved = contact_module.DM1702_contact
+    contact_module.DM1702_contact = cls
+    try:
+        tracemalloc.start()
+        start = default_timer()
+        contacts = list(contact_module.DM1702_contacts.read_csv(infile))
+        elapsed = default_timer() - start
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+    finally:
+        contact_module.DM1702_contact = saved
+    return len(contacts), size, elapsed
+
+def bench_contacts(infile):
+    if tracemalloc is None:
+        raise Exception('Memory benchmark requires tracemalloc (Python 3.4+)')
+    ref = None
+    for name, cls in [('per-instance __dict__', legacy_contact), ('__slots__, interned', contact_module.DM1702_contact)]:
+        count, size, t = load_traced(infile, cls)
+        if not count:
+            raise Exception('No contacts loaded from %s' % infile)
+        ref = ref or size
+        print("%-24s %8i contacts %10.1f MB %6.1f B/contact %6.2f s  %5.2fx" % (name, count, size / 1e6, size / float(count), t, ref / float(size)))
+
+class timed_sim(DM1702_sim):
+    """Simulator keeping its own CPU time apart from the measured code."""
+    cpu = 0.0
+
+    def read(self, size, timeout=None):
+        start = cpu_time()
+        try:
+            return DM1702_sim.read(self, size, timeout)
+        finally:
+            self.cpu += cpu_time() - start
+
+    def write(self, data):
+        start = cpu_time()
+        try:
+            return DM1702_sim.write(self, data)
+        finally:
+            self.cpu += cpu_time() - start
+
+def codeplug_image():
+    """SPI image with codeplug sectors of all known block IDs and test data."""
+    sector = DM1702_DFU.sector_size
+    image = bytearray(b'\xff' * DM1702_sim.flash_size)
+    pos = DM1702_sim.spi_ranges['Settings'][0]
+    for mark in sorted([m for m in DATA_map.values() if m is not None]):
+        image[pos:pos+sector-1] = bytearray([(i * 7 + mark) & 0xff for i in range(sector - 1)])
+        image[pos+sector-1] = mark
+        pos += sector
+    pos = DM1702_sim.spi_ranges['CSVContacts'][0]
+    image[pos:pos+(1 << 20)] = bytearray([(i * 13 + (i >> 12)) & 0xff for i in range(1 << 20)])
+    return image
+
+def firmware_image(size=0xA0000):
+    """Unencrypted firmware passing the download_fw header check."""
+    fw = bytearray([(i * 13) & 0xff for i in range(size)])
+    fw[0:16] = b'\x00\x10\x00\x20\x00\x00\x00\x08\x00\x00\x00\x08\x00\x00\x00\x08'
+    return bytes(fw)
+
+def dfu_operations(size, workdir):
+    """Yields (name, setup, operation) of the measured DFU operations,
+    setup(dfu) brings a fresh radio to the state the operation expects."""
+    spi = DM1702_sim.spi_ranges['CSVContacts'][0]
+    data = bytes(bytearray([(i * 5) & 0xff for i in range(size)]))
+    codeplug = os.path.join(workdir, 'codeplug.data')
+    spi_mode = lambda dfu: dfu.enter_spi_usb_mode()
+    yield 'upload_spi', spi_mode, lambda dfu: dfu.upload_spi(spi, size, crop=False, silent=True)
+    yield 'download_spi', spi_mode, lambda dfu: dfu.download_spi(spi, data, silent=True)
+    yield 'get_cp_map', spi_mode, lambda dfu: dfu.get_cp_map()
+    yield 'upload_codeplug', None, lambda dfu: md1702_dfu.upload_codeplug(dfu, codeplug)
+    yield 'download_codeplug', None, lambda dfu: md1702_dfu.download_codeplug(dfu, codeplug)
+    yield 'download_fw', 'bootloader', lambda dfu: dfu.download_fw(firmware_image())
+
+def bench_dfu_operation(model, image, setup, operation, latency):
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        if setup == 'bootloader':
+            sim = timed_sim(model=model, latency=latency / 2000.0, bootloader=True)
+            dfu = DM1702_DFU(sim, 0)
+            dfu.enter_bootloader_mode()
+        else:
+            sim = timed_sim(image, model, latency / 2000.0)
+            dfu = DM1702_DFU(sim, 0)
+            dfu.configure(options)
+            dfu.enter_dfu_mode()
+            if setup is not None:
+                setup(dfu)
+        sim.stats.clear()
+        sim.cpu = 0.0
+        cpu = cpu_time()
+        start = default_timer()
+        operation(dfu)
+        elapsed = default_timer() - start
+        cpu = cpu_time() - cpu - sim.cpu
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+    size = sim.stats['bytes_read'] + sim.stats['bytes_written'] + sim.stats['fw_blocks'] * 1024
+    kib = max(size, 1) / 1024.0
+    return {
+        'model' : model,
+        'delta' : Deltas[model],
+        'bytes' : size,
+        'seconds' : elapsed,
+        'cpu_seconds' : cpu,
+        'round_trips' : sim.stats['writes'],
+        'transfers' : sim.stats['writes'] + sim.stats['reads'],
+        'kib_per_second' : kib / elapsed,
+        'round_trips_per_kib' : sim.stats['writes'] / kib,
+        'cpu_ms_per_kib' : cpu * 1000 / kib,
+    }
+
+def bench_dfu():
+    """Runs DFU operations of both models against the radio simulator, the
+    simulator's own CPU time is not counted."""
+    latency = float(options.get('latency', 1))
+    size = int(options.get('size', 64)) << 10
+    image = codeplug_image()
+    workdir = tempfile.mkdtemp(prefix='md1702-bench')
+    results = []
+    print("%-8s %-18s %8s %8s %9s %12s %12s" % ('model', 'operation', 'KiB', 's', 'KiB/s', 'trips/KiB', 'CPU ms/KiB'))
+    try:
+        for model in sorted(Deltas):
+            for name, setup, operation in dfu_operations(size, workdir):
+                result = bench_dfu_operation(model, image, setup, operation, latency)
+                result['operation'] = name
+                results.append(result)
+                print("%-8s %-18s %8.1f %8.3f %9.1f %12.2f %12.3f" % (model, name, result['bytes'] / 1024.0, result['seconds'],
+                      result['kib_per_second'], result['round_trips_per_kib'], result['cpu_ms_per_kib']))
+    finally:
+        shutil.rmtree(workdir)
+    if 'json' in options:
+        with open(options['json'], 'w') as f:
+            json.dump({
+                'date' : time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'python' : sys.version.split()[0],
+                'latency_ms' : latency,
+                'window' : int(options.get('window', 1)),
+                'results' : results,
+            }, f, indent=2, sort_keys=True)
+        print("Results stored to %s" % options['json'])
+
+def main():
+    options.update(DM1702_util.pop_options(sys.argv))
+    try:
+        if len(sys.argv) in [2, 3] and sys.argv[1] == 'crc':
+            bench_crc(int(sys.argv[2]) if len(sys.argv) == 3 else 1 << 20)
+        elif len(sys.argv) == 3 and sys.argv[1] == 'contacts':
+            bench_contacts(sys.argv[2])
+        elif len(sys.argv) == 2 and sys.argv[1] == 'dfu':
+            bench_dfu()
+        else:
+            usage()
+    except (RuntimeError, Exception) as e:
+        exc_type, exc_obj, exc_tb = sys.exc_info()
+        fname = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
+        if verbose_err:
+            print(exc_type, fname, exc_tb.tb_lineno)
+        print(e)
+        exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -8,10 +8,17 @@
 # edit in CPS.
 
 import sys
+try:
+    from StringIO import StringIO # Python 2, accepts str
+except ImportError:
+    from io import StringIO
 from DM1702_codeplug import *
+from DM1702_contact import contactFormats, callSorting, DM1702_contact_filter, DM1702_contact_usage
 import os.path
 
 verbose_err = True
+options = {}
+batch_shared = {}
 
 def usage():
     print("""
@@ -30,23 +37,49 @@ Read a raw codeplug file and write SMS messages to output CSV file
 Read contacts and append them to the existing codeplug (major CSV contact formats are supported)
     md1702-codeplug add contacts <input.data> <added.csv> <output.data>
 
+Fill the free contact slots with the most used contacts from a (large) CSV file, ranked by their
+appearance in SMS messages in the codeplug and in md1702-rec recordings, pinned IDs always first
+    md1702-codeplug select contacts <input.data> <candidates.csv> <output.data>
+  Options:
+    --recordings=DIR[,DIR]  directories with recordings named by md1702-rec
+    --pinned=FILE           DMR IDs to be always added (first number on each line)
+    --fill                  fill remaining slots with unused candidates too
+
 Export CPS contacts to major CSV contact formats (use format list to display available formats)
     md1702-codeplug export contacts <input.data> <format> <output.csv>
 
 Convert CPS contacts beteen major CSV contact formats (use format list to display output formats)
     md1702-codeplug convert contacts <input.csv> <format> <output.csv>
 
+Contacts read by add and convert may be filtered while reading large databases with options
+    --country=CZ,DE       country codes/names (as present in the input format)
+    --prefix=230,262      DMR ID prefixes
+    --range=LOW-HIGH      DMR ID range
+    --call=REGEX          callsign regular expression
+    --heard=FILE          only DMR IDs listed in file (first number on each line)
+    --limit=N             keep only first N selected contacts in --sort order
+    --sort=callSign|id|name
+
+Run one of the commands above for many codeplugs in parallel, writing output files named after
+the input files to the output directory. Codeplugs are given by a quoted glob ("radios/*.data")
+or as @manifest.txt with one file per line.
+    md1702-codeplug batch add contacts <codeplugs> <added.csv> <output-dir>
+    md1702-codeplug batch export contacts <codeplugs> <format> <output-dir>
+    md1702-codeplug batch readsms <codeplugs> <output-dir>
+    md1702-codeplug batch readallsms <codeplugs> <output-dir>
+  Options:
+    --jobs=N        number of worker processes (default: number of CPUs)
+    --summary=FILE  per-file results and errors (default: <output-dir>/summary.csv)
+
 """)
 
 def load_cps(infile):
-    f = open(infile,"rb")
-    data = f.read()
-    f.close()
-    return DM1702_codeplug(data)
+    return DM1702_codeplug.from_file(infile)
 
 def save_cps(outfile,cp):
+    cp.detach() # The output may overwrite the memory-mapped input
     f = open(outfile,"wb")
-    f.write(bytes(bytearray(cp.data)))
+    f.write(cp.data)
     f.close()
 
 def save_csv(outfile, header, rows):
@@ -56,9 +89,95 @@ def save_csv(outfile, header, rows):
         of.write(str(rows[k]))
     of.close()
 
+def contact_selection():
+    """Returns read_selected arguments from the contact filter options."""
+    if 'sort' in options:
+        DM1702_contact.set_sort(callSorting[options['sort']] if options['sort'] in callSorting else options['sort'])
+    return {'accept' : DM1702_contact_filter.from_options(options),
+            'limit' : int(options['limit']) if 'limit' in options else None}
+
+def batch_files(spec):
+    """Returns codeplug files from a glob or a @manifest file."""
+    import glob
+    if spec.startswith('@'):
+        with open(spec[1:], 'r') as f:
+            return [l.strip() for l in f if l.strip() != '' and not l.startswith('#')]
+    return sorted(glob.glob(spec))
+
+def batch_init(shared):
+    batch_shared.update(shared)
+
+def batch_job(job):
+    """Runs one batch operation, returns (file, status, output, messages)."""
+    op, infile, arg, outdir = job
+    name = os.path.splitext(os.path.basename(infile))[0]
+    stderr = sys.stderr
+    sys.stderr = log = StringIO()
+    try:
+        cp = load_cps(infile)
+        if op == 'add':
+            cp.contacts.extend(batch_shared['contacts'])
+            cp.save_contacts()
+            outfile = os.path.join(outdir, os.path.basename(infile))
+            save_cps(outfile, cp)
+        elif op == 'export':
+            outfile = os.path.join(outdir, name + '.csv')
+            cp.contacts.save(outfile, arg)
+        else:
+            outfile = os.path.join(outdir, name + '_sms.csv')
+            save_csv(outfile, DM1702_messages.csv_hdr(), cp.get_messages(deleted=(op == 'readallsms')))
+        return (infile, 'OK', outfile, log.getvalue().strip())
+    except Exception as e:
+        return (infile, 'ERROR', '', ("%s %s" % (log.getvalue(), e)).strip())
+    finally:
+        sys.stderr = stderr
+
+def batch(args):
+    """Runs a codeplug operation on many files with a process pool."""
+    import csv
+    import multiprocessing
+    if len(args) == 5 and args[0] in ['add', 'export'] and args[1] == 'contacts':
+        op, spec, arg, outdir = args[0], args[2], args[3], args[4]
+    elif len(args) == 3 and args[0] in ['readsms', 'readallsms']:
+        op, spec, arg, outdir = args[0], args[1], None, args[2]
+    else:
+        usage()
+        return
+    shared = {}
+    if op == 'add': # Parsed once, shared with the workers
+        shared['contacts'] = list(DM1702_contacts.read_selected(arg, **contact_selection()))
+    elif op == 'export' and arg not in contactFormats:
+        raise Exception('Output contact file format not recognized')
+    files = batch_files(spec)
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    jobs = int(options['jobs']) if 'jobs' in options else None
+    summary = options.get('summary', os.path.join(outdir, 'summary.csv'))
+    print('Processing %i codeplugs' % len(files))
+    pool = multiprocessing.Pool(jobs, batch_init, (shared,))
+    errors = 0
+    try:
+        with open(summary, 'w') as f:
+            writer = csv.writer(f)
+            writer.writerow(['file', 'status', 'output', 'messages'])
+            for result in pool.imap_unordered(batch_job, [(op, infile, arg, outdir) for infile in files]):
+                writer.writerow(result)
+                if result[1] != 'OK':
+                    errors += 1
+                    sys.stderr.write('%s: %s\n' % (result[0], result[3]))
+                sys.stdout.write('.')
+                sys.stdout.flush()
+    finally:
+        pool.close()
+        pool.join()
+    print('\nDone, %i of %i codeplugs failed, summary written to %s' % (errors, len(files), summary))
+
 def main():
 #    try:
-        if len(sys.argv) == 4:
+        options.update(DM1702_util.pop_options(sys.argv))
+        if len(sys.argv) > 2 and sys.argv[1] == 'batch':
+            batch(sys.argv[2:])
+        elif len(sys.argv) == 4:
             infile=sys.argv[2]
             outfile=sys.argv[3]
             if sys.argv[1] == 'export':
@@ -81,19 +200,36 @@ def main():
                 if sys.argv[2] == 'contacts':
                     print('Export of contacts')
                     contacts = DM1702_contacts()
-                    contacts.load(infile)
+                    contacts.load(infile, **contact_selection())
                     contacts.save(outfile, sys.argv[4])
             elif sys.argv[1] == 'export':
                 if sys.argv[2] == 'contacts':
                     print('Export of contacts')
                     cp = load_cps(infile)
                     cp.contacts.save(outfile, sys.argv[4])
+            elif sys.argv[1] == 'select':
+                if sys.argv[2] == 'contacts':
+                    print('Selecting most used contacts')
+                    cp = load_cps(infile)
+                    ranking = DM1702_contact_usage()
+                    ranking.add_messages(cp.get_messages())
+                    for path in options['recordings'].split(',') if 'recordings' in options else []:
+                        ranking.add_recordings(path)
+                    if 'pinned' in options:
+                        ranking.pinned = DM1702_contact_filter.load_ids(options['pinned'])
+                    slots = cp.contacts.max_internal_contacts - len(cp.contacts)
+                    selected = ranking.select(DM1702_contacts.read_csv(sys.argv[4]), slots, 'fill' in options, cp.contacts.float_map)
+                    count = len(cp.contacts)
+                    cp.contacts.extend(selected)
+                    print('Added %i contacts for %i free slots' % (len(cp.contacts) - count, slots))
+                    cp.save_contacts()
+                    save_cps(outfile, cp)
             elif sys.argv[1] == 'add':
                 csvfile=sys.argv[4]
                 if sys.argv[2] == 'contacts':
                     print('Adding additional contacts')
                     cp = load_cps(infile)
-                    cp.contacts.load(csvfile)
+                    cp.contacts.load(csvfile, **contact_selection())
                     cp.save_contacts()
                     save_cps(outfile, cp)
             else:
@@ -16,14 +16,16 @@
 from __future__ import print_function
 
 import sys
+import threading
 import time
 
-import usb.core
 import os.path
-import usb.core
+from collections import Counter
 
 from DM1702_DFU import DM1702_DFU, Versions
+from DM1702_dump import DM1702_dump
 from DM1702_codeplug import DATA_map
+from DM1702_data_maps import DM1702_util
 from array import array
 
 # The tricky thing is that *TWO* different applications all show up
@@ -35,6 +37,11 @@ md1702_vendor = 0x0483
 md1702_product = 0x5780
 
 verbose_err = True
+options = {}
+
+# SPI regions read fully by readspi --smart, erased edges of their sectors
+# do not mean the whole sector is erased (e.g. fonts, voice samples)
+dense_regions = [ 'Voices', 'HZKFont', 'Logo' ]
 
 # flash_config = 0x08004000
 # application = 0x08008000
@@ -79,16 +86,27 @@ def upload_config(dfu, filename):
     finally:
         print("Done.")
 
+def spi_regions(dfu):
+    """Returns [(name, (start, end)), ...] of SPI regions reported by the
+    radio, available in program mode only (before SPI USB mode)."""
+    ranges = [ 'Voices', 'HZKFont', 'Recordings', 'Settings', 'Logo', 'Unknown1' ]
+    if dfu.model == 'DM1702S':
+        ranges += [ 'CSVContacts' ]
+    return [(i, dfu.verify_addrs(Versions[i])) for i in ranges]
+
+def region_of(regions, address):
+    """Returns name of the region containing address or None."""
+    for name, (start, end) in regions:
+        if start <= address <= end:
+            return name
+    return None
+
 def display_versions(dfu):
     """Dumps the version information from radio."""
     for i in [ 'FWVersion', 'RefDate', 'DataFormat', 'GPSFormat', 'CPSFormat' ] :
         print("%s= %s"  % (i + (' ' * (12-len(i))), dfu.to_str(dfu.verify(Versions[i]))))
 
-    ranges = [ 'Voices', 'HZKFont', 'Recordings', 'Settings', 'Logo', 'Unknown1' ]
-    if dfu.model == 'DM1702S':
-        ranges += [ 'CSVContacts' ]
-    for i in ranges:
-        start, end = dfu.verify_addrs(Versions[i])
+    for i, (start, end) in spi_regions(dfu):
         print("%s= 0x%06x - 0x%06x "  % (i+ (' ' * (12-len(i))), start, end ))
     dfu.enter_spi_usb_mode()
     print('DeviceID    = 0x%s' % dfu.hd(dfu.verify(Versions['DeviceID'])))
@@ -118,24 +136,65 @@ def upload_firmware(dfu, filename):
     finally:
         f.close()
 
-def upload_all(dfu, filename, start=0, end=0xFFFFFF):
-    """Dumps all SPI flash data, stores even partial results."""
-    f = open(filename, 'wb')
+def spi_read(dfu, func, *args):
+    """Calls a DFU read method, stale replies are drained on failure so
+    that the read may be retried."""
     try:
-        for part in range(start, end, dfu.sector_size):
-            #print ("Part %06x end %06x" % (part,part+dfu.sector_size))
-            data = dfu.upload_spi(part, dfu.sector_size, crop=False, silent=True)
-            if f is not None:
-                f.write(data)
-                f.flush()
-                sys.stdout.write('.')
+        return func(*args)
+    except Exception:
+        dfu._drain()
+        raise
+
+def upload_all(dfu, filename, start=0, end=0xFFFFFF, regions=None, batch=64):
+    """Dumps all SPI flash data to a preallocated file, read sectors are
+    checkpointed, so an interrupted dump resumes where it stopped.
+
+    With a region map (see spi_regions), sectors outside of dense regions
+    are sampled first in batches, only their first and last chunk (with
+    the block ID mark) are read, sectors with both chunks erased are stored
+    as 0xff fill without reading the rest."""
+    size = dfu.sector_size
+    l = dfu.read_delta
+    blank = bytearray(b'\xff' * l)
+    dump = DM1702_dump(filename, start, end, size)
+    if dump.done:
+        print("Resuming dump, %i of %i sectors already read" % (len(dump.done), len(dump.sectors)))
+    summary = {}
+    try:
+        pending = dump.pending()
+        for pos in range(0, len(pending), batch):
+            group = pending[pos:pos+batch]
+            sampled = []
+            if regions is not None and 2 * l < size:
+                sampled = [part for part in group if region_of(regions, part) not in dense_regions]
+            edges = {}
+            if sampled:
+                edges = dict(zip(sampled, dump.fetch(lambda part: spi_read(dfu, dfu.read_edges, sampled), sampled[0], len(sampled))))
+            for part in group:
+                if part not in edges:
+                    data = dump.fetch(lambda part: spi_read(dfu, dfu.upload_spi, part, size, None, None, False, True), part)
+                    state = 'read'
+                elif edges[part][0] == blank and edges[part][1] == blank:
+                    data = b'\xff' * size
+                    state = 'blank'
+                else:
+                    head, tail = edges[part]
+                    middle = dump.fetch(lambda part: spi_read(dfu, dfu.upload_spi, part + l, size - 2 * l, None, None, False, True), part, size - 2 * l)
+                    data = head + bytearray(middle) + tail
+                    state = 'read'
+                dump.put(part, data)
+                name = region_of(regions, part) if regions is not None else None
+                summary.setdefault(name or 'Unlisted', Counter())[state] += 1
+                sys.stdout.write('.' if state == 'read' else '_')
                 sys.stdout.flush()
-            else:
-                hexdump(data)
         sys.stdout.write('\n')
         sys.stdout.flush()
     finally:
-        f.close()
+        if not dump.close():
+            sys.stderr.write("\nDump is incomplete, run the same command again to resume it\n")
+    if regions is not None:
+        for name in sorted(summary):
+            print("%s= %5i sectors read, %5i blank" % (name + (' ' * (12-len(name))), summary[name]['read'], summary[name]['blank']))
 
 def upload(dfu, filename, start=0, end=0xFFFFFF, crop=True):
     """Dumps the SPI flash data for given range."""
@@ -214,8 +273,30 @@ def upload_codeplug(dfu, filename, extra=False):
     finally:
         f.close()
 
-def download_codeplug(dfu, filename, calib=False):
-    """Uploads the SPI CODEPLUG data to flash for given range."""
+def download_changed(dfu, address, data, chunks=False):
+    """Writes only data differing from the radio contents, returns bytes written."""
+    current = dfu.upload_spi(address, len(data), crop=False, silent=True)
+    if current == data:
+        return 0
+    if not chunks:
+        dfu.download_spi(address, data, len(data), silent=True)
+        return len(data)
+    written = pos = 0
+    while pos < len(data):
+        end = pos
+        while end < len(data) and current[end:end+dfu.write_delta] != data[end:end+dfu.write_delta]:
+            end += dfu.write_delta
+        end = min(end, len(data))
+        if end > pos:
+            dfu.download_spi(address + pos, data[pos:end], silent=True)
+            written += end - pos
+        pos = end + dfu.write_delta
+    dfu.update_cache(address, data)
+    return written
+
+def download_codeplug(dfu, filename, calib=False, diff=None):
+    """Uploads the SPI CODEPLUG data to flash for given range. With diff set
+    to 'sector' or 'chunk', only changed sectors or chunks are written."""
     f = open(filename, 'rb')
     if f is None:
         sys.stderr.write("Reading from data file %s failed, giving up\n" % filename)
@@ -253,16 +334,25 @@ def download_codeplug(dfu, filename, calib=False):
         sys.stdout.write('+')
         sys.stdout.flush()
 
+        total = written = 0
         for idx in range(2 if calib else 3 ,max(DATA_map)+1):
             if DATA_map[idx] is None:
                 continue
             part = sector_map[DATA_map[idx]] * dfu.sector_size
+            sdata = data[idx*dfu.sector_size:(idx+1)*dfu.sector_size]
             #print("Uploading data[0x%06x:0x%06x] to address 0x%06x length=0x%04x" % (idx*dfu.sector_size,(idx+1)*dfu.sector_size,part,dfu.sector_size))
-            dfu.download_spi(part, data[idx*dfu.sector_size:(idx+1)*dfu.sector_size], dfu.sector_size, silent=True)
+            if diff:
+                written += download_changed(dfu, part, sdata, diff == 'chunk')
+            else:
+                dfu.download_spi(part, sdata, dfu.sector_size, silent=True)
+                written += dfu.sector_size
+            total += dfu.sector_size
             sys.stdout.write('.')
             sys.stdout.flush()
         sys.stdout.write('\n')
         sys.stdout.flush()
+        if diff:
+            print('Written %i of %i bytes, %i bytes saved.' % (written, total, total - written))
     finally:
         f.close()
 
@@ -273,19 +363,17 @@ def download(dfu, data, start, end):
         raise RuntimeError('Uploaded data size %i is larger than maximum allowed size %i' % (len(data), end-start+1))
     dfu.download_spi(start, data, end-start+1)
 
-def init_dfu(alt=0, dfu_mode=True):
+def init_dfu(alt=0, dfu_mode=True, device=None):
     """Initializes the DFU switching to USB program mode."""
-    dev = usb.core.find(idVendor=md1702_vendor, idProduct=md1702_product)
-
-    if dev is None:
-        raise RuntimeError('Device not found')
+    dev = device if device is not None else DM1702_DFU.select_device(md1702_vendor, md1702_product, options, alt)
 
     dfu = DM1702_DFU(dev, alt)
+    dfu.configure(options)
     if dfu_mode:
         dev.default_timeout = 3000
         try:
             dfu.enter_dfu_mode()
-        except usb.core.USBError as e:
+        except IOError as e: # USBError is an IOError too
             if len(e.args) > 0 and e.args[0] == 'Pipe error':
                 raise RuntimeError('Failed to enter DFU mode. Is the device running in normal mode?')
             else:
@@ -295,6 +383,98 @@ def init_dfu(alt=0, dfu_mode=True):
     return dfu
 
 
+def list_devices():
+    """Lists attached radios with their device IDs (radios are rebooted)."""
+    devices = DM1702_DFU.find_devices(md1702_vendor, md1702_product, options.get('device'))
+    print("%i radio(s) found" % len(devices))
+    for dev in devices:
+        location = DM1702_DFU.location(dev)
+        try:
+            print("%-12s DeviceID = 0x%s" % (location, DM1702_DFU.probe_id(dev)))
+        except Exception as e:
+            print("%-12s not responding (%s)" % (location, e))
+
+class FleetOutput(object):
+    """Replaces sys.stdout in fleet mode, output of each worker thread is kept
+    in its log and progress dots are counted instead of printed."""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+        self.logs = {}
+        self.progress = {}
+
+    def register(self, name):
+        self.local.name = name
+        self.logs[name] = []
+        self.progress[name] = 0
+
+    def write(self, text):
+        name = getattr(self.local, 'name', None)
+        if name is None:
+            self.stream.write(text)
+        elif text != '' and text.strip('.') == '':
+            self.progress[name] += len(text)
+        else:
+            self.logs[name].append(text)
+
+    def flush(self):
+        if getattr(self.local, 'name', None) is None:
+            self.stream.flush()
+
+def fleet(argv):
+    """Runs a command on all selected radios at once, one thread per radio.
+    {device} in the arguments is replaced by the radio location."""
+    if len(argv) < 2 or argv[1] in ['fleet', 'devices']:
+        usage()
+        return
+    devices = DM1702_DFU.select_devices(md1702_vendor, md1702_product, options)
+    if len(devices) == 0:
+        raise RuntimeError('Device not found')
+    output = FleetOutput(sys.stdout)
+    status = {}
+
+    def worker(dev, name):
+        output.register(name)
+        try:
+            run([arg.replace('{device}', name.replace(':', '-')) for arg in argv], dev)
+            status[name] = 'done'
+        except (SystemExit, Exception) as e:
+            output.logs[name].append('%s\n' % e)
+            status[name] = 'FAILED'
+
+    threads = []
+    for dev in devices:
+        name = DM1702_DFU.location(dev)
+        status[name] = 'running'
+        threads.append(threading.Thread(target=worker, args=(dev, name)))
+    print("Running %s on %i radios" % (argv[1], len(devices)))
+    start = time.time()
+    sys.stdout = output
+    try:
+        for thread in threads:
+            thread.start()
+        while [thread for thread in threads if thread.is_alive()]:
+            output.stream.write('\r%5.0fs ' % (time.time() - start) +
+                                ' '.join(['%s:%s' % (name, status[name] if status[name] != 'running' else output.progress.get(name, 0))
+                                          for name in sorted(status)]))
+            output.stream.flush()
+            time.sleep(0.5)
+    finally:
+        for thread in threads:
+            thread.join()
+        sys.stdout = output.stream
+    print('')
+    for name in sorted(status):
+        print('--- %s: %s' % (name, status[name]))
+        log = ''.join(output.logs.get(name, [])).strip()
+        if log:
+            print(log)
+    failed = len([name for name in status if status[name] != 'done'])
+    print('Done in %.1f s, %i of %i radios failed' % (time.time() - start, failed, len(devices)))
+    if failed:
+        exit(1)
+
 def usage():
     print("""
 Usage: md1702-dfu <command> <arguments>
@@ -328,7 +508,10 @@ Write voice data/HZK font/Boot image and from a file (no checking of correct fil
 
 Read a full SPI flash dump including a codeplug and write it to a file (very slow, ~1h)
     md1702-dfu readspi <spiflash.bin> [start [end]]
-    # start/end are hexadecimal offsets
+    # start/end are hexadecimal offsets, failed sectors are retried and an
+    # interrupted dump is resumed by running the same command again
+    # with --smart, sectors outside voice/font/logo regions with erased first
+    # and last chunk are not read fully and stored as erased (0xff)
 
 Dump the config block from Flash memory.
     md1702-dfu readcfg <cfg_filename.bin>
@@ -342,159 +525,200 @@ Reboot the device in normal mode.
 
 Upgrade to new firmware:
     md1702-dfu upgrade <1702_v02_XYZ.bin>
-""")
 
+List attached radios with their locations and device IDs (radios are rebooted).
+    md1702-dfu devices
+
+Run a command on all attached (or selected) radios at once, {device} in file
+names is replaced by the radio location, e.g. read codeplugs of all radios:
+    md1702-dfu fleet read codeplug_{device}.data
+
+Options (may be placed anywhere on the command line):
+    --window=N      keep N SPI read requests in flight (default 1, stop-and-wait),
+                    falls back to stop-and-wait automatically if the radio stalls
+    --cache[=DIR]   keep read 4 KiB SPI sectors in an on-disk cache (default
+                    ~/.cache/md1702-tools), cached sectors are validated by
+                    reading their first and last chunk (with block ID mark)
+                    and a few chunks at random positions in between
+    --cache-size=MB maximum size of the sector cache (default 64)
+    --diff[=chunk]  write/writecal: compare with radio contents (cheap with --cache)
+                    and write only changed sectors, or only changed chunks
+"""
+    + DM1702_DFU.select_usage + """\
+    --tune[=write][,rescan]
+                    probe the largest SPI read (and write) request lengths the
+                    firmware accepts on the first codeplug sector (rewritten with
+                    its own data), remembered per model and firmware version in
+                    ~/.cache/md1702-tools/chunk_profiles.json and probed again
+                    when a stored length is rejected (write lengths are used
+                    with =write only)
+    --stats         print request counts and timings per command and histograms
+                    of USB transfer sizes and latencies at exit (to stderr)
+""")
 
-def main():
-    try:
-        if len(sys.argv) == 3:
-            if sys.argv[1] == 'readcp':
-                dfu = init_dfu()
-                dfu.enter_spi_usb_mode()
-                print("Dumping RAW codeplug.")
-                upload(dfu, sys.argv[2], dfu.cps_start, dfu.cps_end)
 
-            elif sys.argv[1] in ['read', 'readall']:
-                if sys.argv[1] == 'read' and sys.argv[2].split('.')[-1].lower() != "data":
-                    usage()
-                else:
-                    dfu = init_dfu()
-                    print("Dumping DATA CPS file.")
-                    upload_codeplug(dfu, sys.argv[2], sys.argv[1] == 'readall')
+def run(argv, device=None):
+    """Runs one command on the radio (the selected one unless device is given)."""
+    if len(argv) == 3:
+        if argv[1] == 'readcp':
+            dfu = init_dfu(device=device)
+            dfu.enter_spi_usb_mode()
+            print("Dumping RAW codeplug.")
+            upload(dfu, argv[2], dfu.cps_start, dfu.cps_end)
 
-            elif sys.argv[1] == 'readlogo':
-                dfu = init_dfu()
-                print("Dumping Boot logo raw image.")
+        elif argv[1] in ['read', 'readall']:
+            if argv[1] == 'read' and argv[2].split('.')[-1].lower() != "data":
+                usage()
+            else:
+                dfu = init_dfu(device=device)
+                print("Dumping DATA CPS file.")
+                upload_codeplug(dfu, argv[2], argv[1] == 'readall')
+
+        elif argv[1] == 'readlogo':
+            dfu = init_dfu(device=device)
+            print("Dumping Boot logo raw image.")
+            start, end = dfu.verify_addrs(Versions['Logo']) #logo offsets are not available in SPI_USB mode
+            dfu.enter_spi_usb_mode()
+            upload(dfu, argv[2], start, end, crop=False)
+
+        elif argv[1] == 'readfont':
+            dfu = init_dfu(device=device)
+            dfu.enter_spi_usb_mode()
+            print("Dumping HZK font data.")
+            start, end = dfu.verify_addrs(Versions['HZKFont'])
+            upload(dfu, argv[2], start, end)
+
+        elif argv[1] == 'readvoice':
+            dfu = init_dfu(device=device)
+            dfu.enter_spi_usb_mode()
+            print("Dumping Voice data.")
+            start, end = dfu.verify_addrs(Versions['Voices'])
+            upload(dfu, argv[2], start, end)
+
+        elif argv[1] == 'readspi':
+            print("Dumping 16MB of RAW SPI flash data, please be patient, it takes %s." % ('minutes to an hour' if 'smart' in options else 'an hour'))
+            dfu = init_dfu(device=device)
+            regions = spi_regions(dfu) if 'smart' in options else None
+            dfu.enter_spi_usb_mode()
+            upload_all(dfu, argv[2], regions=regions)
+            print('Read complete')
+
+        elif argv[1] == 'readfw':
+            dfu = init_dfu(device=device)
+            upload_firmware(dfu, argv[2])
+
+        elif argv[1] == 'readcfg':
+            dfu = init_dfu(device=device)
+            upload_config(dfu, argv[2])
+
+        elif argv[1] == 'settime':
+            dfu = init_dfu(dfu_mode=False, device=device)
+            dfu.set_time(argv[2])
+
+        elif argv[1] == 'writelogo':
+            with open(argv[2], 'rb') as f:
+                data = f.read()
+                dfu = init_dfu(device=device)
+                print("Setting Boot logo raw image.")
                 start, end = dfu.verify_addrs(Versions['Logo']) #logo offsets are not available in SPI_USB mode
                 dfu.enter_spi_usb_mode()
-                upload(dfu, sys.argv[2], start, end, crop=False)
+                download(dfu, data, start, end)
 
-            elif sys.argv[1] == 'readfont':
-                dfu = init_dfu()
+        elif argv[1] == 'writefont':
+            with open(argv[2], 'rb') as f:
+                data = f.read()
+                dfu = init_dfu(device=device)
                 dfu.enter_spi_usb_mode()
-                print("Dumping HZK font data.")
+                print("Setting HZK font data.")
                 start, end = dfu.verify_addrs(Versions['HZKFont'])
-                upload(dfu, sys.argv[2], start, end)
-
-            elif sys.argv[1] == 'readvoice':
-                dfu = init_dfu()
+                download(dfu, data, start, end)
+
+        elif argv[1] == 'writevoice':
+            with open(argv[2], 'rb') as f:
+                data = f.read()
+                dfu = init_dfu(device=device)
+                if data[:0x1000] == ('\xff' * 0x1000) and data[0x1016:0x101B] == '1.txt':
+                    print('Stock voice data from MD, removing first 0x1000 bytes')
+                    data = data[0x1000:]
                 dfu.enter_spi_usb_mode()
-                print("Dumping Voice data.")
+                print("Setting Voice data.")
                 start, end = dfu.verify_addrs(Versions['Voices'])
-                upload(dfu, sys.argv[2], start, end)
-
-            elif sys.argv[1] == 'readspi':
-                print("Dumping 16MB of RAW SPI flash data, please be patient, it takes an hour.")
-                dfu = init_dfu()
+                download(dfu, data, start, end)
+
+        elif argv[1] in ['write', 'writecal'] and argv[2].split('.')[-1].lower() == "data":
+            dfu = init_dfu(device=device)
+            print("Writing CPS DATA.")
+            download_codeplug(dfu, argv[2], argv[1] == 'writecal',
+                              'sector' if options.get('diff') is True else options.get('diff'))
+
+        elif argv[1] == 'writecp':
+            with open(argv[2], 'rb') as f:
+                data = f.read()
+                if len(data) == 0x3C000:
+                    print('According to the size, this is official codeplug, use write command instead. Aborting.')
+                    return
+                dfu = init_dfu(device=device)
                 dfu.enter_spi_usb_mode()
-                upload_all(dfu, sys.argv[2])
-                print('Read complete')
-
-            elif sys.argv[1] == 'readfw':
-                dfu = init_dfu()
-                upload_firmware(dfu, sys.argv[2])
-
-            elif sys.argv[1] == 'readcfg':
-                dfu = init_dfu()
-                upload_config(dfu, sys.argv[2])
-
-            elif sys.argv[1] == 'settime':
-                dfu = init_dfu(dfu_mode=False)
-                dfu.set_time(sys.argv[2])
-
-            elif sys.argv[1] == 'writelogo':
-                with open(sys.argv[2], 'rb') as f:
-                    data = f.read()
-                    dfu = init_dfu()
-                    print("Setting Boot logo raw image.")
-                    start, end = dfu.verify_addrs(Versions['Logo']) #logo offsets are not available in SPI_USB mode
-                    dfu.enter_spi_usb_mode()
-                    download(dfu, data, start, end)
-
-            elif sys.argv[1] == 'writefont':
-                with open(sys.argv[2], 'rb') as f:
-                    data = f.read()
-                    dfu = init_dfu()
-                    dfu.enter_spi_usb_mode()
-                    print("Setting HZK font data.")
-                    start, end = dfu.verify_addrs(Versions['HZKFont'])
-                    download(dfu, data, start, end)
-
-            elif sys.argv[1] == 'writevoice':
-                with open(sys.argv[2], 'rb') as f:
-                    data = f.read()
-                    dfu = init_dfu()
-                    if data[:0x1000] == ('\xff' * 0x1000) and data[0x1016:0x101B] == '1.txt':
-                        print('Stock voice data from MD, removing first 0x1000 bytes')
-                        data = data[0x1000:]
-                    dfu.enter_spi_usb_mode()
-                    print("Setting Voice data.")
-                    start, end = dfu.verify_addrs(Versions['Voices'])
-                    download(dfu, data, start, end)
-
-            elif sys.argv[1] in ['write', 'writecal'] and sys.argv[2].split('.')[-1].lower() == "data":
-                dfu = init_dfu()
-                print("Writing CPS DATA.")
-                download_codeplug(dfu, sys.argv[2], sys.argv[1] == 'writecal')
-
-            elif sys.argv[1] == 'writecp':
-                with open(sys.argv[2], 'rb') as f:
-                    data = f.read()
-                    if len(data) == 0x3C000:
-                        print('According to the size, this is official codeplug, use write command instead. Aborting.')
-                        return
-                    dfu = init_dfu()
-                    dfu.enter_spi_usb_mode()
-                    print("Writing RAW codeplug.")
-                    download(dfu, data, dfu.cps_start, dfu.cps_end)
-
-            elif sys.argv[1] == "upgrade":
-                with open(sys.argv[2], 'rb') as f:
-                    data = f.read()
-                    dfu = init_dfu(dfu_mode=False)
-                    dfu.enter_bootloader_mode()
-                    dfu.set_timeout(60000)
-                    dfu.download_fw(data, sys.argv[2])
-            else:
-                usage()
+                print("Writing RAW codeplug.")
+                download(dfu, data, dfu.cps_start, dfu.cps_end)
 
-        elif len(sys.argv) == 2:
-            if sys.argv[1] == 'settime':
-                dfu = init_dfu(dfu_mode=False)
-                dfu.set_time()
+        elif argv[1] == "upgrade":
+            with open(argv[2], 'rb') as f:
+                dfu = init_dfu(dfu_mode=False, device=device)
+                dfu.enter_bootloader_mode()
+                dfu.set_timeout(60000)
+                dfu.download_fw(f, argv[2]) # streamed from the file
+        else:
+            usage()
 
-            elif sys.argv[1] == 'reboot':
-                dfu = init_dfu()
-                dfu.reboot()
+    elif len(argv) == 2:
+        if argv[1] == 'settime':
+            dfu = init_dfu(dfu_mode=False, device=device)
+            dfu.set_time()
 
-            elif sys.argv[1] == 'versions':
-                dfu = init_dfu()
-                display_versions(dfu)
+        elif argv[1] == 'reboot':
+            dfu = init_dfu(device=device)
+            dfu.reboot()
 
-            elif sys.argv[1] == "upgrade_check":
-                dfu = init_dfu(dfu_mode=False)
-                dfu.enter_bootloader_mode()
-                print ("Please turn off the radio now.")
-            else:
+        elif argv[1] == 'versions':
+            dfu = init_dfu(device=device)
+            display_versions(dfu)
+
+        elif argv[1] == "upgrade_check":
+            dfu = init_dfu(dfu_mode=False, device=device)
+            dfu.enter_bootloader_mode()
+            print ("Please turn off the radio now.")
+        else:
+            usage()
+
+    elif len(argv) in [4,5]:
+        if argv[1] == 'readspi':
+            try:
+                start=int(argv[3], 16)
+                end=int(argv[4], 16) if len(argv) == 5 else 0xffffff
+            except:
                 usage()
+                exit(1)
+            dfu = init_dfu(device=device)
+            regions = spi_regions(dfu) if 'smart' in options else None
+            dfu.enter_spi_usb_mode()
+            print("Dumping partial RAW SPI flash data from 0x%06x to 0x%06x, please be patient, it takes %s~%.2f minutes." %\
+                  (start, end, 'up to ' if regions is not None else '', dfu.estimate_upload_time(start, end - start) / 60))
+            upload_all(dfu, argv[2], start, end, regions)
+            print('Read complete')
 
-        elif len(sys.argv) in [4,5]:
-            if sys.argv[1] == 'readspi':
-                try:
-                    start=int(sys.argv[3], 16)
-                    end=int(sys.argv[4], 16) if len(sys.argv) == 5 else 0xffffff
-                except:
-                    usage()
-                    exit(1)
-                print("Dumping partial RAW SPI flash data from 0x%06x to 0x%06x, please be patient, it takes ~%.2f minutes." %\
-                      (start, end, (end - start) * 0.0000032))
-                dfu = init_dfu()
-                dfu.enter_spi_usb_mode()
-                upload_all(dfu, sys.argv[2],start, end)
-                print('Read complete')
+    else:
+        usage()
 
+def main():
+    options.update(DM1702_util.pop_options(sys.argv))
+    try:
+        if len(sys.argv) > 2 and sys.argv[1] == 'fleet':
+            fleet(sys.argv[1:])
+        elif len(sys.argv) == 2 and sys.argv[1] == 'devices':
+            list_devices()
         else:
-            usage()
+            run(sys.argv)
     except (RuntimeError, Exception) as e:
         exc_type, exc_obj, exc_tb = sys.exc_info()
         fname = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
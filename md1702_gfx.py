@@ -9,10 +9,17 @@
 # blue background and buttons is not drawn and remains with what was in boot
 # logo until some editor widget with white background is used.
 
-from PIL import Image
+from PIL import Image, ImageDraw, ImageFont
 import os.path
 import sys
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from DM1702_data_maps import DM1702_util
+
 # For now works only with the known DM-1702/DM-X display format. If needed,
 # the following two values may have to be changed to reflect other radio
 # display dimensions and 16-byte header
@@ -23,6 +30,8 @@ logo_hdr = B'\x02\xa0\x80\x00\x50\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00'
 python_v2 = (sys.version.split('.')[0] == '2')
 
 verbose_err = True
+options = {}
+batch_shared = {}
 
 def usage():
     print("""
@@ -32,59 +41,138 @@ Read a Boot image from a file and write it to bootlogo image
     md1702-gfx toimage <bootlogo.bin> <bootlogo.png>
 
 Read a bootlogo image and write it to Boot image
-    md1702-gfx fromimage <bootlogo.png> <bootlogo.bin>
+    md1702-gfx fromimage [--dither=ordered|fs] <bootlogo.png> <bootlogo.bin>
 
 Read a bootlogo image and show it on screen
     md1702-gfx show <bootlogo.bin>
+
+Create bootlogo images for many radios from a template image and a CSV file
+with a header row (e.g. callsign,dmr_id,unit). Text lines are separated by |
+and refer to the CSV columns, by default each column is written on its line
+    md1702-gfx batch [--text="{callsign}|ID {dmr_id}"] [--name="{callsign}.bin"]
+                     [--pos=X,Y] [--font=<font.ttf>] [--font-size=N] [--color=RRGGBB]
+                     [--dither=ordered|fs] [--jobs=N] [--summary=<summary.csv>]
+                     <template.png> <radios.csv> <output-dir>
 """)
 
-def gfx_from_image(data):
-    odata = bytearray()
-    i = 0
-    while i < len(data):
-        if python_v2:
-            rgb8 = ((ord(data[i]) & 0xe0) | ((ord(data[i+1]) & 0xe0) >> 3) | (ord(data[i+2]) >> 6))
-        else:
-            rgb8 = (((data[i]) & 0xe0) | (((data[i+1]) & 0xe0) >> 3) | ((data[i+2]) >> 6))
-        i += 3
-        if python_v2:
-            odata += chr(rgb8)
-        else:
-            odata.append(rgb8)
-    return bytes(odata)
+# RGB332 pixel format: 3 bits of red, 3 bits of green and 2 bits of blue. The
+# conversion works on whole images using lookup tables, with NumPy if present
 
-def gfx_to_image(data):
-    odata = bytearray()
-    for b in data:
-        if python_v2:
-            b = ord(b)
-        red = b & 0xe0
-        if red == 0xe0:
-            red = 0xff;
-        else:
-            red |= red >> 4
+def rgb332_to_rgb(b):
+    red = b & 0xe0
+    if red == 0xe0:
+        red = 0xff;
+    else:
+        red |= red >> 4
 
-        green = (b << 3) & 0xe0
-        if green == 0xe0:
-            green = 0xff;
-        else:
-            green |= green >> 4
+    green = (b << 3) & 0xe0
+    if green == 0xe0:
+        green = 0xff;
+    else:
+        green |= green >> 4
 
-        blue = (b << 6) & 0xc0
-        if blue == 0xc0:
-            blue = 0xff;
-        else:
-            blue|= blue >> 4
+    blue = (b << 6) & 0xc0
+    if blue == 0xc0:
+        blue = 0xff;
+    else:
+        blue|= blue >> 4
+    return red, green, blue
 
-        if python_v2:
-            rgb = chr(red) + chr(green) + chr(blue)
-            odata += rgb
-        else:
-            odata.append(red)
-            odata.append(green)
-            odata.append(blue)
+gfx_decode_lut = [bytes(bytearray(rgb332_to_rgb(b))) for b in range(256)]
+
+# Position (shift) and size of the red, green and blue bits and 4x4 Bayer
+# matrix for ordered dithering
+gfx_channels = [(5, 3), (2, 3), (0, 2)]
+gfx_bayer = [[0, 8, 2, 10], [12, 4, 14, 6], [3, 11, 1, 9], [15, 7, 13, 5]]
+
+gfx_encode_luts = {}
+
+def gfx_encode_lut(threshold=None):
+    """Returns bytes.translate tables of the red, green and blue channel bits,
+    cached for reuse. Without threshold lower bits are dropped, with a Bayer
+    matrix value (0-15) the two nearest displayed levels are dithered."""
+    if threshold not in gfx_encode_luts:
+        luts = []
+        for channel, (shift, bits) in enumerate(gfx_channels):
+            levels = [rgb332_to_rgb(k << shift)[channel] for k in range(1 << bits)]
+            lut = bytearray()
+            for c in range(256):
+                k = c >> (8 - bits)
+                if threshold is not None:
+                    k = max([i for i in range(len(levels)) if levels[i] <= c])
+                    if k + 1 < len(levels) and (c - levels[k]) * 32 > (threshold * 2 + 1) * (levels[k+1] - levels[k]):
+                        k += 1
+                lut.append(k << shift)
+            luts.append(bytes(lut))
+        gfx_encode_luts[threshold] = luts
+    return gfx_encode_luts[threshold]
+
+def gfx_combine(data, start, stop, stride, luts):
+    """Converts every stride-th pixel of RGB888 data[start:stop] to RGB332."""
+    red, green, blue = [data[start+i:stop:stride*3].translate(lut) for i, lut in enumerate(luts)]
+    if python_v2:
+        return bytearray([r | g | b for r, g, b in zip(bytearray(red), bytearray(green), bytearray(blue))])
+    return (int.from_bytes(red, 'big') | int.from_bytes(green, 'big') |
+            int.from_bytes(blue, 'big')).to_bytes(len(red), 'big')
+
+gfx_numpy_luts = None
+
+def gfx_from_image_numpy(data, dither=None, width=gfx_size[0]):
+    global gfx_numpy_luts
+    pixels = numpy.frombuffer(data, dtype=numpy.uint8).reshape(-1, 3)
+    if dither == 'ordered':
+        if gfx_numpy_luts is None:
+            gfx_numpy_luts = numpy.array([[bytearray(lut) for lut in gfx_encode_lut(t)] for t in range(16)], dtype=numpy.uint8)
+        luts = gfx_numpy_luts
+        rows = len(pixels) // width
+        bayer = numpy.tile(numpy.array(gfx_bayer), (rows // 4 + 1, width // 4 + 1))[:rows, :width].reshape(-1)
+        rgb8 = luts[bayer, 0, pixels[:, 0]] | luts[bayer, 1, pixels[:, 1]] | luts[bayer, 2, pixels[:, 2]]
+    else:
+        rgb8 = (pixels[:, 0] & 0xe0) | ((pixels[:, 1] & 0xe0) >> 3) | (pixels[:, 2] >> 6)
+    return rgb8.astype(numpy.uint8).tobytes()
+
+def gfx_from_image(data, dither=None, width=gfx_size[0]):
+    """Converts RGB888 pixel data to RGB332, optionally with ordered dithering
+    (Floyd-Steinberg needs the whole image, see image_to_gfx)."""
+    data = bytes(data)
+    if numpy is not None:
+        return gfx_from_image_numpy(data, dither, width)
+    if dither != 'ordered':
+        return bytes(gfx_combine(data, 0, len(data), 1, gfx_encode_lut()))
+    odata = bytearray(len(data) // 3)
+    for y in range(len(odata) // width):
+        row = y * width
+        for x in range(4):
+            luts = gfx_encode_lut(gfx_bayer[y % 4][x])
+            odata[row+x:row+width:4] = gfx_combine(data, (row + x) * 3, (row + width) * 3, 4, luts)
     return bytes(odata)
 
+gfx_palette_image = None
+
+def gfx_palette():
+    """Returns (and caches) a palette image of all RGB332 colours, the palette
+    index of each colour is its RGB332 value."""
+    global gfx_palette_image
+    if gfx_palette_image is None:
+        gfx_palette_image = Image.new("P", (1, 1))
+        gfx_palette_image.putpalette(bytearray(b''.join(gfx_decode_lut)))
+    return gfx_palette_image
+
+def image_to_gfx(im, dither=None):
+    """Converts a PIL image to RGB332, dither may be None, 'ordered' or 'fs'."""
+    im = im.convert("RGB")
+    if dither == 'fs':
+        return im.quantize(palette=gfx_palette(), dither=Image.FLOYDSTEINBERG).tobytes()
+    elif dither not in [None, 'ordered']:
+        raise Exception("Unknown dithering %s, use ordered or fs" % dither)
+    return gfx_from_image(im.tobytes(), dither, im.size[0])
+
+def gfx_to_image(data):
+    if numpy is not None:
+        lut = numpy.frombuffer(b''.join(gfx_decode_lut), dtype=numpy.uint8).reshape(256, 3)
+        return lut[numpy.frombuffer(bytes(data), dtype=numpy.uint8)].tobytes()
+    return b''.join([gfx_decode_lut[b] for b in bytearray(data)])
+
 def read_file(infile):
     if infile.split(".")[-1] == 'txt':
         odata=bytearray()
@@ -133,28 +221,134 @@ def write_file(outfile, hdr,data):
             f.write(data)
             f.close()
 
+def load_image(infile):
+    """Opens an image scaled to the display size, returns it with the header
+    saved along it by toimage (or the default one)."""
+    im = Image.open(infile)
+    if im is not None:
+        im.thumbnail(gfx_size)
+    hdr = None
+    hdrfile = infile + '.hdr'
+    if os.path.isfile(hdrfile):
+        with open(hdrfile, 'rb') as f:
+            hdr = f.read()
+            f.close()
+    if hdr is None:
+        hdr = logo_hdr
+    return im, hdr
+
+def batch_init(shared):
+    """Prepares the template, font and quantisation tables once per worker."""
+    batch_shared.update(shared)
+    im, hdr = load_image(shared['template'])
+    batch_shared['image'] = im.convert("RGB")
+    batch_shared['hdr'] = hdr
+    if shared['font'] is not None:
+        batch_shared['font'] = ImageFont.truetype(shared['font'], shared['font_size'])
+    else:
+        batch_shared['font'] = ImageFont.load_default()
+    if shared['dither'] == 'fs':
+        gfx_palette()
+    elif numpy is None:
+        for threshold in ([None] if shared['dither'] is None else range(16)):
+            gfx_encode_lut(threshold)
+
+def batch_text_size(draw, text, font):
+    if hasattr(draw, 'multiline_textbbox'):
+        box = draw.multiline_textbbox((0, 0), text, font=font, align='center')
+        return box[2], box[3]
+    return draw.multiline_textsize(text, font=font)
+
+def batch_job(row):
+    """Renders one logo, returns (name, status, output, messages)."""
+    name = batch_shared['name']
+    try:
+        if None in row or None in row.values():
+            raise Exception('Row does not match the CSV header: %s' % row)
+        name = name.format(**row)
+        text = '\n'.join([line.format(**row) for line in batch_shared['text'].split('|')])
+        im = batch_shared['image'].copy()
+        draw = ImageDraw.Draw(im)
+        font = batch_shared['font']
+        if batch_shared['pos'] is not None:
+            pos = batch_shared['pos']
+        else: # Centered at the bottom
+            width, height = batch_text_size(draw, text, font)
+            pos = ((im.size[0] - width) // 2, im.size[1] - height - 4)
+        draw.multiline_text(pos, text, fill=batch_shared['color'], font=font, align='center')
+        outfile = os.path.join(batch_shared['outdir'], name)
+        write_file(outfile, batch_shared['hdr'], image_to_gfx(im, batch_shared['dither']))
+        return (name, 'OK', outfile, '')
+    except Exception as e:
+        return (name, 'ERROR', '', str(e))
+
+def batch(args):
+    """Renders personalised boot logos from a template with a process pool."""
+    import csv
+    import multiprocessing
+    if len(args) != 3:
+        usage()
+        return
+    template, fields, outdir = args
+    with open(fields, 'r') as f:
+        reader = csv.DictReader(f)
+        rows = list(reader)
+        columns = reader.fieldnames
+    if not rows:
+        raise Exception('No radios found in %s' % fields)
+    dither = options.get('dither')
+    if dither not in [None, 'ordered', 'fs']:
+        raise Exception("Unknown dithering %s, use ordered or fs" % dither)
+    color = options.get('color', 'ffffff')
+    shared = {
+        'template' : template,
+        'outdir' : outdir,
+        'text' : options.get('text', '|'.join(['{%s}' % c for c in columns])),
+        'name' : options.get('name', '{%s}.bin' % columns[0]),
+        'pos' : tuple([int(x) for x in options['pos'].split(',')]) if 'pos' in options else None,
+        'font' : options.get('font'),
+        'font_size' : int(options.get('font-size', 16)),
+        'color' : (int(color[0:2], 16), int(color[2:4], 16), int(color[4:6], 16)),
+        'dither' : dither,
+    }
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    jobs = int(options['jobs']) if 'jobs' in options else None
+    summary = options.get('summary', os.path.join(outdir, 'summary.csv'))
+    print('Rendering %i bootlogo images' % len(rows))
+    pool = multiprocessing.Pool(jobs, batch_init, (shared,))
+    errors = 0
+    try:
+        with open(summary, 'w') as f:
+            writer = csv.writer(f)
+            writer.writerow(['name', 'status', 'output', 'messages'])
+            for result in pool.imap_unordered(batch_job, rows, 8):
+                writer.writerow(result)
+                if result[1] != 'OK':
+                    errors += 1
+                    sys.stderr.write('%s: %s\n' % (result[0], result[3]))
+                sys.stdout.write('.')
+                sys.stdout.flush()
+    finally:
+        pool.close()
+        pool.join()
+    print('\nDone, %i of %i images failed, summary written to %s' % (errors, len(rows), summary))
+
 def main():
+    options.update(DM1702_util.pop_options(sys.argv))
     try:
-        if len(sys.argv) == 4:
+        if len(sys.argv) > 2 and sys.argv[1] == 'batch':
+            batch(sys.argv[2:])
+        elif len(sys.argv) == 4:
             infile=sys.argv[2]
             outfile=sys.argv[3]
 
             if sys.argv[1] == 'fromimage':
-                hdrfile = infile + '.hdr'
-                im = Image.open(infile)
+                im, hdr = load_image(infile)
                 if im is None:
                     print("The image could not be opened")
                     return
-                im.thumbnail(gfx_size)
-                im=im.convert("RGB")
-                hdr = None
-                if os.path.isfile(hdrfile):
-                    with open(infile + '.hdr', 'rb') as f:
-                        hdr = f.read()
-                        f.close()
-                if hdr is None:
-                    hdr = logo_hdr
-                data = gfx_from_image(im.tobytes())
+                data = image_to_gfx(im, options.get('dither'))
                 write_file(outfile, hdr, data)
             elif sys.argv[1] == 'toimage':
                 data=read_file(infile)
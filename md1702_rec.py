@@ -14,10 +14,12 @@ from struct import *
 from datetime import datetime
 
 from DM1702_DFU import DM1702_DFU, Versions
+from DM1702_data_maps import DM1702_util, DM1702_bitmap
 
 md1702_vendor = 0x0483
 md1702_product = 0x5780
 verbose_err = True
+options = {}
 
 # We are defining custom header for DMR recordings in modded DSD
 
@@ -54,6 +56,8 @@ class recording(object):
     FILE_EXT = ".dmr"
     #verbose = True
     verbose = False
+    __slots__ = ('block', 'src_dmr_id', 'dst_dmr_id', 'date_time', 'zone', 'zone_ch',
+                 'next_blocks', 'duration', 'mode', 'valid', 'bank', 'type', 'data')
 
     @staticmethod
     def get_size(dfu, block, warn=True):
@@ -198,14 +202,8 @@ def get_state(dfu, block):
     return state
 
 def get_allocated_map(dfu, block):
-    data=dfu.to_str(dfu.upload_spi((block * 0x1000), 0xffe , crop=False, silent=True))
-    odata = []
-    for c in data:
-        if isinstance(c,str):
-            c = ord(c)
-        for j in range(7):
-            odata.append(((c >> j) & 0x1 == 0x0))
-    return odata
+    data=dfu.upload_spi((block * 0x1000), 0xffe , crop=False, silent=True)
+    return DM1702_bitmap(data, width=7)
 
 def get_recording_starts(dfu, block):
     data=(dfu.upload_spi((block * 0x1000), 0xffe , crop=False, silent=True))
@@ -282,7 +280,7 @@ def show_record_info(dfu, start):
         state = get_state(dfu, sblock + i)
         print('Bitmap sector %i:  %s (0x%02x)' % (i, Sector_state[state], state))
         if state == 0xa5 or state == 0x0:
-            print('  \'-- Allocated:  %i' % get_allocated_map(dfu,sblock+i).count(True))
+            print('  \'-- Allocated:  %i' % get_allocated_map(dfu,sblock+i).count())
     maxs=6
     if fwversion >= 22: maxs=9
     for i in range(3,maxs):
@@ -296,12 +294,10 @@ def show_record_info(dfu, start):
 
 def init_dfu(alt=0, dfu_mode=True):
     """Initializes the DFU switching to USB program mode."""
-    dev = usb.core.find(idVendor=md1702_vendor, idProduct=md1702_product)
-
-    if dev is None:
-        raise RuntimeError('Device not found')
+    dev = DM1702_DFU.select_device(md1702_vendor, md1702_product, options, alt)
 
     dfu = DM1702_DFU(dev, alt)
+    dfu.configure(options)
     if dfu_mode:
         dev.default_timeout = 3000
         try:
@@ -366,9 +362,27 @@ Information about allocated sectors
 
 Reboot the device.
     md1702-rec reboot
+
+Options (may be placed anywhere on the command line):
+    --window=N      keep N SPI read requests in flight (default 1, stop-and-wait)
+    --cache[=DIR]   keep read 4 KiB SPI sectors in an on-disk cache (default
+                    ~/.cache/md1702-tools)
+    --cache-size=MB maximum size of the sector cache (default 64)
+"""
+    + DM1702_DFU.select_usage + """\
+    --tune[=write][,rescan]
+                    probe the largest SPI read (and write) request lengths the
+                    firmware accepts on the first codeplug sector (rewritten with
+                    its own data), remembered per model and firmware version in
+                    ~/.cache/md1702-tools/chunk_profiles.json and probed again
+                    when a stored length is rejected (write lengths are used
+                    with =write only)
+    --stats         print request counts and timings per command and histograms
+                    of USB transfer sizes and latencies at exit (to stderr)
 """)
 
 def main():
+    options.update(DM1702_util.pop_options(sys.argv))
     try:
         if len(sys.argv) == 3 or len(sys.argv) == 4:
             if (len(sys.argv) == 4):
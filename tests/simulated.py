@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+
+# Helpers for tests running DM1702_DFU against the protocol level simulator,
+# no radio or PyUSB is needed.
+
+from __future__ import print_function
+
+from DM1702_DFU import DM1702_DFU
+from DM1702_sim import DM1702_sim
+
+class Captured(list):
+    """Collects text written to a replaced sys.stdout or sys.stderr."""
+
+    def write(self, text):
+        self.append(text)
+
+    def flush(self):
+        pass
+
+def pattern(length, seed=0):
+    """Returns length bytes of non-erased test data."""
+    return bytearray([(i * 7 + (i >> 12) + seed) & 0x7f for i in range(length)])
+
+def image(data_end=0x40000):
+    """SPI image with test data up to data_end, erased above."""
+    return pattern(data_end) + bytearray(b'\xff' * (DM1702_sim.flash_size - data_end))
+
+def open_dfu(sim, spi_mode=True, options=None):
+    """Returns DM1702_DFU on the simulator in program (and SPI USB) mode."""
+    dfu = DM1702_DFU(sim, 0)
+    if options is not None:
+        dfu.configure(options)
+    dfu.enter_dfu_mode()
+    if spi_mode:
+        dfu.enter_spi_usb_mode()
+    return dfu
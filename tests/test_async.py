@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+
+import threading
+import unittest
+
+try:
+    import asyncio
+    from DM1702_async import DM1702_AsyncDFU
+except (ImportError, SyntaxError): # Python 2
+    asyncio = None
+
+from DM1702_sim import DM1702_sim
+from simulated import image
+
+class BarrierSim(DM1702_sim):
+    """Blocks the first SPI read until all radios in barrier have sent theirs."""
+
+    def __init__(self, image, barrier):
+        DM1702_sim.__init__(self, image, 'DM1702S', latency=0.001)
+        self.barrier = barrier
+
+    def write(self, data):
+        if self.barrier is not None and self.spi_mode and bytearray(data)[:1] == b'R':
+            barrier, self.barrier = self.barrier, None
+            barrier.wait()
+        return DM1702_sim.write(self, data)
+
+@unittest.skipIf(asyncio is None, 'asyncio requires Python 3.5+')
+class AsyncTest(unittest.TestCase):
+
+    def setUp(self):
+        self.image = image()
+        self.loop = asyncio.new_event_loop()
+        self.radios = []
+
+    def tearDown(self):
+        for radio in self.radios:
+            radio.close()
+        self.loop.close()
+
+    def run_async(self, coroutine):
+        return self.loop.run_until_complete(coroutine)
+
+    def open(self, sim):
+        radio = self.run_async(DM1702_AsyncDFU.open(sim))
+        self.radios.append(radio)
+        self.run_async(radio.enter_spi_usb_mode())
+        return radio
+
+    def test_concurrent_upload(self):
+        # all radios must be reading at the same time to pass the barrier
+        barrier = threading.Barrier(12, timeout=5)
+        radios = [self.open(BarrierSim(self.image, barrier)) for i in range(12)]
+        progress = [[] for radio in radios]
+        uploads = [self.loop.create_task(radio.upload_spi(0x800 * i, 0x2800, False, lambda done, total, p=progress[i]: p.append(done)))
+                   for i, radio in enumerate(radios)]
+        results = self.run_async(asyncio.gather(*uploads))
+        for i, data in enumerate(results):
+            self.assertEqual(data, self.image[0x800 * i:0x800 * i + 0x2800])
+        self.assertEqual(progress[0], [0x1000, 0x2000, 0x2800])
+        self.assertEqual(progress[1], [0x800, 0x1800, 0x2800])
+
+    def test_cancel(self):
+        radio = self.open(DM1702_sim(self.image, 'DM1702S', latency=0.001))
+        progress = []
+        def cancel(done, total):
+            progress.append(done)
+            task.cancel()
+        task = self.loop.create_task(radio.upload_spi(0, 0x10000, False, cancel))
+        self.assertRaises(asyncio.CancelledError, self.run_async, task)
+        self.assertEqual(progress, [0x1000])
+        # the radio is usable after the cancelled step finished
+        self.assertEqual(self.run_async(radio.upload_spi(0x3000, 0x1000, False)), self.image[0x3000:0x4000])
+
+if __name__ == '__main__':
+    unittest.main()
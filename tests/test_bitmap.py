@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+
+import unittest
+
+from DM1702_data_maps import DM1702_bitmap
+
+def expanded(data, inverted=False, width=8):
+    """Slots of data one by one, a cleared bit is used unless inverted."""
+    return [((c >> j) & 0x1 == 0x1) == inverted for c in bytearray(data) for j in range(width)]
+
+class BitmapTest(unittest.TestCase):
+
+    def test_slots(self):
+        for data in [b'\xfe\xff\x7f', b'\x00\x00\x00', b'\xff\xff\xff', b'\x5a\x81\x3c']:
+            for inverted in [False, True]:
+                bmap = DM1702_bitmap(data, inverted)
+                slots = expanded(data, inverted)
+                self.assertEqual(len(bmap), 24)
+                self.assertEqual(list(bmap), slots)
+                self.assertEqual([bmap[i] for i in range(24)], slots)
+                self.assertEqual(bmap.count(), slots.count(True))
+                self.assertEqual(bmap.count(False), slots.count(False))
+
+    def test_boundaries(self):
+        bmap = DM1702_bitmap(b'\xfe\xff\x7f')
+        self.assertEqual((bmap[0], bmap[1], bmap[22], bmap[23], bmap[-1]), (True, False, False, True, True))
+        self.assertRaises(IndexError, bmap.__getitem__, 24)
+        self.assertRaises(IndexError, bmap.__getitem__, -25)
+        self.assertEqual(DM1702_bitmap(b'\x00' * 4).count(), 32)
+        self.assertEqual(DM1702_bitmap(b'').count(), 0)
+
+    def test_width(self):
+        # the recording maps use the lowest 7 bits of each byte only
+        data = b'\x80\xfe\x7f\x00'
+        bmap = DM1702_bitmap(data, width=7)
+        self.assertEqual(len(bmap), 28)
+        self.assertEqual(list(bmap), expanded(data, width=7))
+        self.assertEqual(bmap.count(), 15)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+
+import shutil
+import tempfile
+import unittest
+
+from DM1702_sim import DM1702_sim
+from simulated import image, open_dfu, pattern
+
+class SectorCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.options = {'cache' : self.path}
+        self.sim = DM1702_sim(image())
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def read(self, address=0x2000, length=0x1000):
+        dfu = open_dfu(self.sim, options=self.options)
+        return bytearray(dfu.upload_spi(address, length, crop=False, silent=True))
+
+    def test_cached_read(self):
+        self.assertEqual(self.read(), self.sim.flash[0x2000:0x3000])
+        reads = self.sim.stats['R']
+        self.assertEqual(self.read(), self.sim.flash[0x2000:0x3000])
+        self.assertTrue(self.sim.stats['R'] - reads < 10)
+
+    def test_write_before_cache_opened(self):
+        self.read()
+        # the head and the tail of the cached sector stay the same
+        open_dfu(self.sim, options=self.options).download_spi(0x2400, pattern(0x800, 5), silent=True)
+        self.assertEqual(self.read(), self.sim.flash[0x2000:0x3000])
+
+    def test_changed_sector_middle(self):
+        self.read()
+        # same head and tail (with the block ID mark), different contents
+        self.sim.flash[0x2000+0x100:0x3000-0x100] = pattern(0xe00, 9)
+        self.assertEqual(self.read(), self.sim.flash[0x2000:0x3000])
+
+if __name__ == '__main__':
+    unittest.main()
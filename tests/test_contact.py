@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from DM1702_contact import DM1702_contact, DM1702_contacts, DM1702_contact_filter, DM1702_contact_usage
+
+def contact(cid, call=None):
+    return DM1702_contact(cid, call or 'C%i' % cid, ctype='private')
+
+class ContactIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.contacts = DM1702_contacts()
+        for cid, call, ctype in [(2300003, 'OK1C', 'private'), (230, 'CZECH', 'group'), (2300001, 'OK1A', 'private'),
+                                 (230, 'CZECH', 'private'), (2300002, 'OK1A', 'private'), (2300003, 'OK1B', 'private')]:
+            self.contacts.append(DM1702_contact(cid, call, ctype=ctype))
+
+    def tearDown(self):
+        DM1702_contact.set_sort()
+
+    def test_duplicates(self):
+        # same ID and type is dropped, same call with another ID is relabelled
+        self.assertEqual([(str(c), c.cid) for c in self.contacts.clist],
+                         [('OK1C', 2300003), ('CZECH', 230), ('OK1A', 2300001), ('CZECH-1', 230), ('OK1A-1', 2300002)])
+
+    def test_sorted_indexes(self):
+        self.assertEqual(self.contacts.sorted_calls(), ['CZECH', 'CZECH-1', 'OK1A', 'OK1A-1', 'OK1C'])
+        self.assertEqual(self.contacts.sorted_ids(), [230.0, 230.1, 2300001.0, 2300002.0, 2300003.0])
+        # appended keys are merged into the existing indexes
+        self.contacts.append(DM1702_contact(2300000, 'AA1A', ctype='private'))
+        self.assertEqual(self.contacts.sorted_calls(), ['AA1A', 'CZECH', 'CZECH-1', 'OK1A', 'OK1A-1', 'OK1C'])
+        self.assertEqual(self.contacts.sorted_ids(), [230.0, 230.1, 2300000.0, 2300001.0, 2300002.0, 2300003.0])
+
+    def test_sort(self):
+        self.contacts.sort('id')
+        self.assertEqual([c.cid for c in self.contacts.clist], [230, 230, 2300001, 2300002, 2300003])
+        for what in ['OK1C', 2300002, 230.1]:
+            self.assertEqual(self.contacts.clist[self.contacts.get_index(what)], self.contacts[what])
+        self.assertEqual(self.contacts['OK1A-1'].cid, 2300002)
+        self.assertEqual(self.contacts[230.0].call, 'CZECH-1')
+        self.assertEqual(self.contacts[9.0], None)
+
+class ContactImportTest(unittest.TestCase):
+    rows = [(2300001, 'OK1AA', 'Adam', 'CZ'), (2620001, 'DL1AA', 'Bert', 'DE'), (2300002, 'OK1BB', 'Cyril', 'CZ'),
+            (2310001, 'OM1AA', 'Dano', 'SK'), (2300003, 'OL1CC', 'Emil', 'CZ'), (2620002, 'DK1BB', 'Fritz', 'DE')]
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.csv = os.path.join(self.path, 'users.csv')
+        with open(self.csv, 'w') as f:
+            f.write('num;dmrid;callsign;name;country;ctry;dev_id\n')
+            for i, (cid, call, name, ctry) in enumerate(self.rows):
+                f.write('%i;%i;%s;%s;;%s;\n' % (i + 1, cid, call, name, ctry))
+        self.heard = os.path.join(self.path, 'heard.txt')
+        with open(self.heard, 'w') as f:
+            f.write('2620002,DK1BB\n"2300001"\nnot an ID\n')
+
+    def tearDown(self):
+        DM1702_contact.set_sort()
+        shutil.rmtree(self.path)
+
+    def read(self, options=None, limit=None):
+        accept = DM1702_contact_filter.from_options(options or {})
+        return [c.cid for c in DM1702_contacts.read_selected(self.csv, accept=accept, limit=limit)]
+
+    def test_no_filter(self):
+        self.assertEqual(DM1702_contact_filter.from_options({'limit' : '3'}), None)
+        self.assertEqual(self.read(), [row[0] for row in self.rows])
+
+    def test_filters(self):
+        self.assertEqual(self.read({'country' : 'cz, sk'}), [2300001, 2300002, 2310001, 2300003])
+        self.assertEqual(self.read({'prefix' : '262,231'}), [2620001, 2310001, 2620002])
+        self.assertEqual(self.read({'range' : '2300002-2310001'}), [2300002, 2310001, 2300003])
+        self.assertEqual(self.read({'call' : '^o[kl]1.[bc]$'}), [2300002, 2300003])
+        self.assertEqual(self.read({'heard' : self.heard}), [2300001, 2620002])
+        self.assertEqual(self.read({'country' : 'CZ', 'call' : '^OK'}), [2300001, 2300002])
+
+    def test_limit(self):
+        DM1702_contact.set_sort('I')
+        self.assertEqual(self.read(limit=2), [2300001, 2300002])
+        self.assertEqual(self.read({'country' : 'DE'}, 5), [2620001, 2620002])
+        DM1702_contact.set_sort('N')
+        self.assertEqual(self.read({'prefix' : '262,231'}, 2), [2620001, 2310001])
+        self.assertEqual(self.read(limit=0), [])
+
+class CodeplugContactsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.contacts = DM1702_contacts()
+        for i in range(13):
+            self.contacts.append(DM1702_contact(2300000 + i * 37, 'OK%iABCDEFGHIJKLMNO' % i, ctype='private'))
+        self.contacts.append(DM1702_contact(9, 'Local', ctype='group'))
+        self.contacts.append(DM1702_contact(16777215, 'All', ctype='all'))
+
+    def fields(self, contacts):
+        return [(c.call, c.cid, c.type) for c in contacts.clist]
+
+    def test_records(self):
+        cmap, cdata, skipped = self.contacts.export_CP()
+        self.assertEqual((len(cmap), len(cdata), skipped), (0xd80, 15 * DM1702_contact.contact_len, 0))
+        size = DM1702_contact.contact_len
+        for i, c in enumerate(self.contacts.clist):
+            self.assertEqual(bytes(cdata[i * size:(i + 1) * size]), c.to_MD_record())
+
+    def test_round_trip(self):
+        cmap, cdata, skipped = self.contacts.export_CP()
+        # records beyond the allocation bitmap and a partial record are ignored
+        cdata += DM1702_contact(2309999, 'EXTRA', ctype='private').to_MD_record() + b'\xff' * 5
+        contacts = DM1702_contacts(cdata, cmap)
+        self.assertEqual(self.fields(contacts), [(c.call[:16], c.cid, c.type) for c in self.contacts.clist])
+        self.assertEqual(contacts.sorted_calls(), sorted([c.call[:16] for c in self.contacts.clist]))
+        cmap2, cdata2, skipped = contacts.export_CP()
+        self.assertEqual((cmap2, cdata2), (cmap, cdata[:len(cdata2)]))
+
+class ContactUsageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        for name in ['2019-06-01_10-00-00_A_2300002_TG230_RX_Z1C1', '2019-06-01_10-01-00_B_2300002_2300003_TX_Z1C1.amb',
+                     'rec_2019-06-01_10-02-00_A_2300003_TG230_RX_Z1C2', 'notes.txt']:
+            open(os.path.join(self.path, name), 'w').close()
+        self.usage = DM1702_contact_usage()
+        self.usage.add_recordings(self.path)
+        self.candidates = [contact(cid) for cid in [2300001, 2300002, 2300003, 2300004, 2300005]]
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def select(self, *args, **kwargs):
+        return [c.cid for c in self.usage.select(self.candidates, *args, **kwargs)]
+
+    def test_ranking(self):
+        self.assertEqual(self.usage.counts[2300002], 2)
+        self.assertEqual(self.usage.counts[2300003], 2)
+        self.assertEqual(self.usage.counts[230], 2)
+        self.assertEqual(self.select(10), [2300002, 2300003])
+        self.assertEqual(self.select(1), [2300002])
+        self.assertEqual(self.select(3, fill=True), [2300002, 2300003, 2300001])
+
+    def test_pinned(self):
+        self.usage.pinned = set([2300005])
+        self.assertEqual(self.select(2), [2300005, 2300002])
+        self.assertEqual(self.select(10), [2300005, 2300002, 2300003])
+
+    def test_duplicates_skipped(self):
+        self.usage.pinned = set([2300004])
+        contacts = DM1702_contacts()
+        for c in [contact(2300002), contact(2300004)]:
+            contacts.append(c)
+        # the same ID again in the candidates is not selected twice
+        self.candidates.append(contact(2300003, 'OTHER'))
+        selected = self.usage.select(self.candidates, 2, True, contacts.float_map)
+        self.assertEqual([c.cid for c in selected], [2300003, 2300001])
+        contacts.extend(selected)
+        self.assertEqual(len(contacts), 4)
+
+if __name__ == '__main__':
+    unittest.main()
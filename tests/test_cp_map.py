@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+
+import shutil
+import tempfile
+import unittest
+
+from DM1702_sim import DM1702_sim
+from simulated import image, open_dfu
+
+class CodeplugMapTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.sim = DM1702_sim(image(0))
+        for index, mark in [(1, 0x02), (2, 0x16), (5, 0x24), (9, 0x00)]:
+            self.sim.flash[(index << 12) + 0xfff] = mark
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def cp_map(self, window=1):
+        return open_dfu(self.sim, options={'cache' : self.path, 'window' : window}).get_cp_map()
+
+    def test_map(self):
+        for window in [1, 8]:
+            self.assertEqual(self.cp_map(window), {0x02 : 1, 0x16 : 2, 0x24 : 5})
+
+    def test_block_added_to_unmapped_sector(self):
+        self.cp_map()
+        self.sim.flash[(7 << 12) + 0xfff] = 0x45
+        self.assertEqual(self.cp_map(), {0x02 : 1, 0x16 : 2, 0x24 : 5, 0x45 : 7})
+
+    def test_block_moved(self):
+        self.cp_map()
+        self.sim.flash[(5 << 12) + 0xfff] = 0x00
+        self.sim.flash[(9 << 12) + 0xfff] = 0x24
+        self.assertEqual(self.cp_map(), {0x02 : 1, 0x16 : 2, 0x24 : 9})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import md1702_dfu
+from DM1702_dump import DM1702_dump
+from DM1702_sim import DM1702_sim, to_bytes
+from simulated import Captured, image, open_dfu, pattern
+
+class FlakySim(DM1702_sim):
+    """Answers every fail_every-th READ request with an error, stops the
+    dump after stop_at READ requests."""
+
+    def __init__(self, image, fail_every=0, stop_at=None):
+        DM1702_sim.__init__(self, image)
+        self.fail_every = fail_every
+        self.stop_at = stop_at
+        self.count = 0
+
+    def write(self, data):
+        data = bytearray(to_bytes(data))
+        if data[:1] == b'R':
+            self.count += 1
+            if self.stop_at is not None and self.count > self.stop_at:
+                raise KeyboardInterrupt()
+            if self.fail_every and self.count % self.fail_every == 0:
+                data = bytearray(b'\xee')
+        return DM1702_sim.write(self, data)
+
+class DumpTest(unittest.TestCase):
+    start, end = 0x10000, 0x30000
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.filename = os.path.join(self.path, 'spi.bin')
+        self.image = image()
+        self.saved = DM1702_dump.retries, DM1702_dump.backoff
+        DM1702_dump.backoff = 0.001
+
+    def tearDown(self):
+        DM1702_dump.retries, DM1702_dump.backoff = self.saved
+        shutil.rmtree(self.path)
+
+    def dump(self, sim, start=None, end=None, smart=False):
+        """Runs upload_all on sim, returns what it wrote to stderr."""
+        start = self.start if start is None else start
+        end = self.end if end is None else end
+        dfu = open_dfu(sim, spi_mode=False)
+        regions = md1702_dfu.spi_regions(dfu) if smart else None
+        dfu.enter_spi_usb_mode()
+        output = sys.stdout, sys.stderr
+        sys.stdout, sys.stderr = Captured(), Captured()
+        try:
+            md1702_dfu.upload_all(dfu, self.filename, start, end, regions)
+        finally:
+            stderr = ''.join(sys.stderr)
+            sys.stdout, sys.stderr = output
+        return stderr
+
+    def dumped(self):
+        with open(self.filename, 'rb') as f:
+            return bytearray(f.read())
+
+    def checkpoint(self):
+        return os.path.exists(self.filename + '.ckpt')
+
+    def interrupt(self, stop_at=2000):
+        self.assertRaises(KeyboardInterrupt, self.dump, FlakySim(self.image, stop_at=stop_at))
+        self.assertTrue(self.checkpoint())
+
+    def test_resume(self):
+        self.interrupt()
+        sim = DM1702_sim(self.image)
+        self.dump(sim)
+        self.assertEqual(self.dumped(), self.image[self.start:self.end])
+        self.assertFalse(self.checkpoint())
+        full = DM1702_sim(self.image)
+        self.dump(full)
+        self.assertTrue(sim.stats['R'] < full.stats['R'] - 1000)
+
+    def test_corrupted_sector_read_again(self):
+        self.interrupt()
+        with open(self.filename, 'r+b') as f:
+            f.seek(0x123)
+            f.write(b'\x00\x01\x02')
+        self.dump(DM1702_sim(self.image))
+        self.assertEqual(self.dumped(), self.image[self.start:self.end])
+
+    def test_different_range_starts_over(self):
+        self.interrupt()
+        stderr = self.dump(DM1702_sim(self.image), self.start, self.end + 0x1000)
+        self.assertTrue('different range' in stderr)
+        self.assertEqual(self.dumped(), self.image[self.start:self.end + 0x1000])
+
+    def test_retry(self):
+        stderr = self.dump(FlakySim(self.image, fail_every=1001))
+        self.assertTrue('retrying' in stderr)
+        self.assertEqual(self.dumped(), self.image[self.start:self.end])
+        self.assertFalse(self.checkpoint())
+
+    def test_permanent_failure(self):
+        DM1702_dump.retries = 2
+        self.assertRaises(Exception, self.dump, FlakySim(self.image, fail_every=1))
+        self.assertTrue(self.checkpoint())
+        self.assertEqual(os.path.getsize(self.filename), self.end - self.start)
+        self.dump(DM1702_sim(self.image))
+        self.assertEqual(self.dumped(), self.image[self.start:self.end])
+
+    def test_smart(self):
+        # Settings data, a Logo sector with data in its middle only and
+        # blank sectors of Unknown1 and above
+        self.image[0xc4000:0xc6000] = pattern(0x2000, 5)
+        self.image[0xca400:0xcac00] = pattern(0x800, 7)
+        start, end = 0xc4000, 0xd8000
+        full = DM1702_sim(self.image)
+        self.dump(full, start, end)
+        smart = DM1702_sim(self.image)
+        self.dump(smart, start, end, smart=True)
+        self.assertEqual(self.dumped(), self.image[start:end])
+        self.assertTrue(smart.stats['R'] < full.stats['R'] // 2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+
+import sys
+import unittest
+
+from DM1702_DFU import Deltas, Versions
+from DM1702_sim import DM1702_sim, to_bytes
+from simulated import Captured, image, open_dfu, pattern
+
+class LossySim(DM1702_sim):
+    """Drops the reply to the n-th READ request and its NEXT."""
+
+    def __init__(self, image, lost):
+        DM1702_sim.__init__(self, image)
+        self.lost = lost
+        self.skip = False
+
+    def write(self, data):
+        data = bytearray(to_bytes(data))
+        if data[:1] == b'R':
+            self.lost -= 1
+            self.skip = self.lost == 0
+        if self.skip:
+            return len(data)
+        return DM1702_sim.write(self, data)
+
+class SimulatorTest(unittest.TestCase):
+
+    def test_identification(self):
+        for model in Deltas:
+            dfu = open_dfu(DM1702_sim(model=model), spi_mode=False)
+            self.assertEqual(dfu.model, model)
+            self.assertEqual(dfu.delta, Deltas[model])
+            self.assertEqual(dfu.verify_addrs(Versions['Settings']), DM1702_sim.spi_ranges['Settings'])
+            dfu.enter_spi_usb_mode()
+            self.assertEqual(dfu.identity(), ('12345678', DM1702_sim.info['FWVersion']))
+
+    def test_spi_read_write(self):
+        img = image()
+        for model in Deltas:
+            for window in [1, 4]:
+                sim = DM1702_sim(img, model)
+                dfu = open_dfu(sim, options={'window' : window})
+                self.assertEqual(bytearray(dfu.upload_spi(0x1000, 0x3000, crop=False, silent=True)), img[0x1000:0x4000])
+                data = pattern(0x1800, 3)
+                dfu.download_spi(0x50100, data, silent=True)
+                self.assertEqual(sim.flash[0x50100:0x51900], data)
+                self.assertEqual(dfu.window, window)
+
+    def test_pipeline_fallback(self):
+        img = image()
+        for lost, window in [(10, 4), (48, 4), (10, 1)]:
+            dfu = open_dfu(LossySim(img, lost), options={'window' : window})
+            stderr, sys.stderr = sys.stderr, Captured()
+            try:
+                data = bytearray(dfu.upload_spi(0x1000, 0xc00, crop=False, silent=True))
+            except IOError:
+                data = None
+            finally:
+                stderr, sys.stderr = sys.stderr, stderr
+            if window == 1:
+                self.assertEqual(data, None)
+                continue
+            # the message names the request which was not answered
+            delta = dfu.read_delta
+            self.assertTrue("at 0x%06x, len=%i stalled" % (0x1000 + (lost - 1) * delta, delta) in ''.join(stderr))
+            self.assertEqual(data, img[0x1000:0x1c00])
+            self.assertEqual(dfu.window, 1)
+
+    def test_too_long_request_rejected(self):
+        dfu = open_dfu(DM1702_sim(chunk_size=40))
+        self.assertRaises(IOError, dfu.upload_spi, 0, 0x100, 64, None, False, True)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+
+import unittest
+
+from DM1702_sim import DM1702_sim
+from simulated import image, open_dfu
+
+class StatsTest(unittest.TestCase):
+
+    def calls(self, window):
+        sim = DM1702_sim(image())
+        dfu = open_dfu(sim, options={'window' : window})
+        dfu.enable_stats(lambda summary: None)
+        dfu.upload_spi(0x1000, 0x2000, crop=False, silent=True)
+        return dict([((c['method'], c['command']), c['count']) for c in dfu.stats.summary()['calls']])
+
+    def test_read_replies_by_request(self):
+        chunks = (0x2000 + 39) // 40
+        for window in [1, 4]:
+            calls = self.calls(window)
+            self.assertEqual(calls[('read', 'R')], chunks)
+            self.assertEqual(calls[('send_data', 'R')], chunks)
+            self.assertEqual(calls[('send_text', 'NEXT')], chunks)
+            self.assertEqual(calls[('read_reply', 'NEXT')], chunks)
+            self.assertFalse(('read', 'NEXT') in calls)
+
+if __name__ == '__main__':
+    unittest.main()
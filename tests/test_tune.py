@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from DM1702_sim import DM1702_sim
+from simulated import image, open_dfu, pattern
+
+class TuneTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.profiles = os.path.join(self.path, 'profiles.json')
+        self.image = image()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def tune(self, model, chunk_size, **flags):
+        self.sim = DM1702_sim(self.image, model, chunk_size=chunk_size)
+        self.dfu = open_dfu(self.sim)
+        return self.dfu.tune(path=self.profiles, **flags)
+
+    def check_transfers(self):
+        """Reads and writes with the tuned lengths, the image is unchanged."""
+        self.assertEqual(bytearray(self.dfu.upload_spi(0x4000, 0x3000, crop=False, silent=True)), self.image[0x4000:0x7000])
+        data = pattern(0x1400, 3)
+        self.dfu.download_spi(0x50000, data, silent=True)
+        self.assertEqual(self.sim.flash[0x50000:0x51400], data)
+        self.assertEqual(self.sim.flash[:0x40000], self.image[:0x40000])
+
+    def test_probe(self):
+        for model, chunk_size, expected in [('DMR1702', 40, 40), ('DMR1702', 128, 128), ('DM1702S', 1024, 1024), ('DM1702S', 8192, 4096)]:
+            profile = self.tune(model, chunk_size, write=True, rescan=True)
+            self.assertEqual(profile, {'read' : expected, 'write' : expected})
+            self.assertEqual((self.dfu.read_delta, self.dfu.write_delta), (expected, expected))
+            self.check_transfers()
+
+    def test_stored_profile(self):
+        self.tune('DM1702S', 1024, write=True)
+        reads = self.sim.stats['R']
+        self.assertEqual(self.tune('DM1702S', 1024), {'read' : 1024, 'write' : 1024})
+        self.assertTrue(self.sim.stats['R'] < reads)
+        # stored write length is used only when writes are tuned
+        self.assertEqual((self.dfu.read_delta, self.dfu.write_delta), (1024, 0x100))
+        self.check_transfers()
+
+    def test_stored_profile_rejected(self):
+        self.tune('DM1702S', 4096)
+        self.assertEqual(self.tune('DM1702S', 1024), {'read' : 1024})
+        self.check_transfers()
+        with open(self.profiles) as f:
+            self.assertEqual(list(json.load(f).values()), [{'read' : 1024}])
+
+    def test_stored_write_rejected(self):
+        self.tune('DM1702S', 4096, write=True)
+        self.assertEqual(self.tune('DM1702S', 512, write=True), {'read' : 512, 'write' : 512})
+        self.check_transfers()
+
+if __name__ == '__main__':
+    unittest.main()